@@ -0,0 +1,281 @@
+### = Annotation for section of code
+## = Todo
+# = General annotations, explains pieces of code.
+
+### Benchmark for generator.py
+# Generates a synthetic tree of source files, then times full builds of it (each in a new process, like a real run of the script) and every phase of a build (in this process, with each phase wrapped by a timer).
+# The same parameters and seed always generate the same source files, so results of different versions of generator.py can be compared. Results are saved as JSON.
+
+import os
+import sys, getopt
+import json
+import time
+import random
+import shutil
+import hashlib
+import platform
+import tempfile
+import subprocess
+import statistics
+import shlex
+
+script_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
+generator_path = os.path.join(script_dir, "generator.py")
+
+args = sys.argv[1:]
+short_options = "hp:r:o:"
+long_options = ["help", "posts=", "body-lines=", "markup=", "categories=", "category-count=", "months=", "images=", "seed=", "repeat=", "output=", "compare=", "generator-options="]
+try:
+    arguments, trailing = getopt.getopt(args, short_options, long_options)
+except getopt.GetoptError as err:
+    print(err)
+    sys.exit(2)
+
+# Default values of the synthetic source tree
+parameters = dict()
+parameters["posts"] = 1000
+parameters["body_lines"] = 20
+parameters["markup"] = 0.05
+parameters["categories"] = 2
+parameters["category_count"] = 20
+parameters["months"] = 24
+parameters["images"] = 0.1
+parameters["seed"] = 1
+repeat = 5
+results_path = "benchmark.json"
+compare_path = None
+generator_options = list()
+
+def get_number(option, value, number_type, minimum, maximum=None):
+    try:
+        number = number_type(value)
+    except ValueError:
+        number = minimum - 1
+    if number < minimum or (maximum is not None and number > maximum):
+        print(f"Invalid value for {option}: {value}")
+        sys.exit(2)
+    return number
+
+for option, value in arguments:
+    if option in ("-h", "--help"):
+        print("Usage: benchmark.py [OPTIONS]")
+        print("Options:")
+        print("-h, --help\tPrint this help text and exit")
+        print("-p N, --posts=N\tNumber of source files to generate. (Default: 1000)")
+        print("--body-lines=N\tNumber of lines of body text in every source file. (Default: 20)")
+        print("--markup=F\tFraction of words that are written in italics, bold or code, from 0 to 1. (Default: 0.05)")
+        print("--categories=N\tNumber of categories of every post. (Default: 2)")
+        print("--category-count=N\tNumber of different categories in the whole source tree. (Default: 20)")
+        print("--months=N\tNumber of months that the dates of the posts are spread across. (Default: 24)")
+        print("--images=F\tFraction of posts that contain an (IMAGE) line, from 0 to 1. (Default: 0.1)")
+        print("--seed=N\tSeed for generating the source tree. (Default: 1)")
+        print("-r N, --repeat=N\tNumber of times every measurement is repeated. The median is reported. (Default: 5)")
+        print("-o 'path/to/results.json', --output='path/to/results.json'\tFile that the results are saved to. (Default: benchmark.json)")
+        print("--compare='path/to/results.json'\tCompare the results of this run with previously saved results.")
+        print("--generator-options='OPTIONS'\tAdditional command line options for generator.py, e.g. --generator-options='--no-subdirs'")
+        sys.exit(0)
+    elif option in ("-p", "--posts"):
+        parameters["posts"] = get_number(option, value, int, 1)
+    elif option in ("--body-lines",):
+        parameters["body_lines"] = get_number(option, value, int, 1)
+    elif option in ("--markup",):
+        parameters["markup"] = get_number(option, value, float, 0, 1)
+    elif option in ("--categories",):
+        parameters["categories"] = get_number(option, value, int, 0)
+    elif option in ("--category-count",):
+        parameters["category_count"] = get_number(option, value, int, 1)
+    elif option in ("--months",):
+        parameters["months"] = get_number(option, value, int, 1)
+    elif option in ("--images",):
+        parameters["images"] = get_number(option, value, float, 0, 1)
+    elif option in ("--seed",):
+        parameters["seed"] = get_number(option, value, int, 0)
+    elif option in ("-r", "--repeat"):
+        repeat = get_number(option, value, int, 1)
+    elif option in ("-o", "--output"):
+        results_path = os.path.expanduser(value)
+    elif option in ("--compare",):
+        compare_path = os.path.expanduser(value)
+    elif option in ("--generator-options",):
+        generator_options = shlex.split(value)
+
+if parameters["categories"] > parameters["category_count"]:
+    print("--categories can not be larger than --category-count.")
+    sys.exit(2)
+if "--watch" in generator_options:
+    print("--watch can not be benchmarked.")
+    sys.exit(2)
+if compare_path is not None and not os.path.isfile(compare_path):
+    print(f"Could not find the results to compare with at: {compare_path}")
+    sys.exit(2)
+
+### Generate the synthetic source tree
+# Source files are spread across subdirectories of 500 files each. Every source file has a title, a date, categories and a number, followed by body text.
+# A 1x1 PNG is saved at the root of the source tree for (IMAGE) lines to point to.
+words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit", "sed", "do", "eiusmod", "tempor", "incididunt", "ut", "labore", "et", "dolore", "magna", "aliqua", "enim", "ad", "minim", "veniam", "quis", "nostrud", "exercitation"]
+markup = [("*", "*"), ("**", "**"), ("```", "```")]
+png_data = bytes.fromhex("89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+                         "1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082")
+
+def generate_body(rng):
+    lines = list()
+    for line_number in range(parameters["body_lines"]):
+        line = list()
+        for word_number in range(rng.randint(6, 18)):
+            word = rng.choice(words)
+            if rng.random() < parameters["markup"]:
+                start, end = rng.choice(markup)
+                word = start + word + end
+            line.append(word)
+        lines.append(" ".join(line))
+    return "\n".join(lines)
+
+def generate_source_tree(source_dir):
+    rng = random.Random(parameters["seed"])
+    categories = ["category " + str(number) for number in range(parameters["category_count"])]
+    with open(os.path.join(source_dir, "image.png"), "wb") as f:
+        f.write(png_data)
+    for number in range(parameters["posts"]):
+        post_dir = os.path.join(source_dir, "part" + str(number // 500))
+        if not os.path.isdir(post_dir):
+            os.mkdir(post_dir)
+        month = rng.randrange(parameters["months"])
+        date = f"{month % 12 + 1:02d}/{rng.randint(1, 28):02d}/{(20 + month // 12) % 100:02d} {rng.randint(0, 23)}:{rng.randint(0, 59):02d}"
+        text = list()
+        text.append("TITLE=Post " + str(number))
+        text.append("DATE=" + date)
+        text.append("CATEGORY=" + ",".join(rng.sample(categories, parameters["categories"])))
+        text.append("NUMBER=" + str(number))
+        text.append("(START)")
+        if rng.random() < parameters["images"]:
+            text.append("(IMAGE ../image.png)")
+        text.append(generate_body(rng))
+        text.append("(STOP)")
+        with open(os.path.join(post_dir, f"post{number:06d}.txt"), "w") as f:
+            f.write("\n".join(text) + "\n")
+
+def write_config(work_dir, source_dir):
+    config_path = os.path.join(work_dir, "config.ini")
+    with open(config_path, "w") as f:
+        f.write("[Paths]\n")
+        f.write("OutputDirectory = " + os.path.join(work_dir, "output") + "\n")
+        f.write("SourceDirectory = " + source_dir + "\n")
+        for key, name in (("PageTemplate", "page_template.html"), ("PostTemplate", "post_template.html"), ("NavigationTemplate", "navigation_template.html"), ("StyleSheet", "stylesheet.css")):
+            f.write(key + " = " + os.path.join(script_dir, "doc", "example_" + name) + "\n")
+    return config_path
+
+### Functions for timing builds
+# Every build starts with an empty output directory, so that all pages are written.
+def get_output_dir(work_dir):
+    output_dir = os.path.join(work_dir, "output")
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    os.mkdir(output_dir)
+    return output_dir
+
+def time_full_build(work_dir, config_path):
+    output_dir = get_output_dir(work_dir)
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, generator_path, "-c", config_path, "-o", output_dir] + generator_options, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        print("generator.py failed:")
+        print(result.stderr)
+        sys.exit(2)
+    return elapsed
+
+# Functions of generator.py that are timed, by phase. Time spent in a phase is added up over all calls of its function.
+# Parsing includes reading the source file. Writing includes assembling every page (and formatting its posts with --low-memory).
+phase_functions = {"scan": "scan_source_files", "parse": "parse_source_file", "date": "set_date", "sort": "sort_posts", "number": "number_posts", "plan": "plan_listings", "format": "format_post", "write": "write_pages", "cleanup": "remove_old_pages", "build": "build"}
+
+def wrap_function(namespace, name, phase, phase_times):
+    function = namespace[name]
+    def timed_function(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            phase_times[phase] += time.perf_counter() - start
+    namespace[name] = timed_function
+
+# generator.py is loaded into this process and configured with configure(). Its functions are then replaced by timed versions before build() is called.
+# Functions of generator.py look up each other by name when they are called, so they call the timed versions as well.
+# Phases are always timed with a single process, since the timed functions can not be sent to the worker processes of -j.
+def time_phases(work_dir, config_path):
+    output_dir = get_output_dir(work_dir)
+    with open(generator_path, "r") as f:
+        code = compile(f.read(), generator_path, "exec")
+    namespace = {"__name__": "benchmark_generator", "__file__": generator_path}
+    stdout = sys.stdout
+    try:
+        with open(os.devnull, "w") as devnull:
+            sys.stdout = devnull
+            exec(code, namespace)
+            namespace["configure"](["-c", config_path, "-o", output_dir] + generator_options)
+            namespace["jobs"] = 1
+            phase_times = dict.fromkeys(phase_functions, 0.0)
+            for phase, name in phase_functions.items():
+                wrap_function(namespace, name, phase, phase_times)
+            namespace["build"]()
+    finally:
+        sys.stdout = stdout
+    counts = {"source_files": len(namespace["parsed_posts"]), "pages": len(namespace["all_pages"])}
+    return phase_times, counts
+
+### Run the benchmark
+work_dir = tempfile.mkdtemp(prefix="3s_benchmark.")
+try:
+    source_dir = os.path.join(work_dir, "source")
+    os.mkdir(source_dir)
+    print(f"Generating {parameters['posts']} source files...")
+    generate_source_tree(source_dir)
+    config_path = write_config(work_dir, source_dir)
+
+    full_build_runs = list()
+    phase_runs = {phase: list() for phase in phase_functions}
+    for run in range(repeat):
+        print(f"Run {run + 1} of {repeat}")
+        full_build_runs.append(time_full_build(work_dir, config_path))
+        phase_times, counts = time_phases(work_dir, config_path)
+        for phase in phase_functions:
+            phase_runs[phase].append(phase_times[phase])
+finally:
+    shutil.rmtree(work_dir)
+
+with open(generator_path, "rb") as f:
+    generator_hash = hashlib.sha1(f.read()).hexdigest()
+results = dict()
+results["generator"] = generator_hash
+results["python"] = platform.python_version()
+results["platform"] = platform.platform()
+results["parameters"] = parameters
+results["generator_options"] = generator_options
+results["repeat"] = repeat
+results["counts"] = counts
+results["full_build"] = {"median": statistics.median(full_build_runs), "min": min(full_build_runs), "runs": full_build_runs}
+results["phases"] = {phase: {"median": statistics.median(runs), "min": min(runs), "runs": runs} for phase, runs in phase_runs.items()}
+with open(results_path, "w") as f:
+    json.dump(results, f, indent=2)
+
+### Print the results (median of all runs, in seconds). With --compare, the change relative to the previous results is printed as well.
+previous = None
+if compare_path is not None:
+    with open(compare_path, "r") as f:
+        previous = json.load(f)
+    if previous["parameters"] != parameters or previous["generator_options"] != generator_options:
+        print("Note: The results to compare with were measured with different parameters.")
+
+def print_result(name, median, previous_median):
+    line = f"{name:<12}{median:>10.4f} s"
+    if previous_median:
+        line += f"{(median - previous_median) / previous_median:>+10.1%}"
+    print(line)
+
+print(f"\n{counts['source_files']} source files, {counts['pages']} pages")
+print_result("full build", results["full_build"]["median"], previous["full_build"]["median"] if previous else None)
+for phase in phase_functions:
+    previous_median = None
+    if previous and phase in previous["phases"]:
+        previous_median = previous["phases"][phase]["median"]
+    print_result(phase, results["phases"][phase]["median"], previous_median)
+print(f"\nResults saved to {results_path}")
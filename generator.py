@@ -3,97 +3,244 @@
 # = General annotations, explains pieces of code.
 
 import os
+import io
 import sys, getopt
 import configparser
 import datetime
+import re
+import hashlib
+import json
+import sqlite3
+import multiprocessing
 import shutil
+import tempfile
+import locale
+import stat
+import time
+import threading
+import functools
+import traceback
+import tracemalloc
+import gzip
+import struct
+import concurrent.futures
+import cProfile
+import http.server
+import urllib.parse
+import html
 from operator import attrgetter
 
 ### Handle command line options/arguments
-args = sys.argv[1:]
-short_options = "htnfrc:o:a"
-long_options = ["help", "sort-by-title", "sort-by-number", "sort-by-filename", "reversed", "config=", "output=", "absolute-paths", "no-subdirs", "no-date-hypertext", "no-title-hypertext"]
-try:
-    arguments, trailing = getopt.getopt(args, short_options, long_options)
-except getopt.GetoptError as err:
-    print(err)
-    sys.exit(2)
-
-# By default search for config in the same directory as where this script is located.
-# If the user is already in the directory where the config and script are located (and therefore script_dir==""), then don't add a "/" before "config.ini"
-script_dir = os.path.dirname(sys.argv[0])
-if script_dir == "":
-    config = "config.ini"
-else:
-    config = script_dir + "/config.ini"
-
-reverse_mode = True
-file_mode = False
-number_mode = False
-title_mode = False
-custom_output = False
-absolute_paths = False
-no_subdirs = False
-no_date_hypertext = False
-no_title_hypertext = False
-for option, value in arguments:
-    if option in ("-c", "--config"):
-        config = os.path.expanduser(value)
-    elif option in ("-a", "--absolute-paths"):
-        absolute_paths = True
-    elif option in ("-o", "--output"):
-        custom_output = True
-        try:
-            os.mkdir(value)
-        except:
-            pass
-        output_dir = os.path.expanduser(value)
-        output_dir = os.path.abspath(output_dir) + "/"
-    elif option in ("-h", "--help"):
-        print("Usage: generator.py [OPTIONS]")
-        print("Options:")
-        print("(DEFAULT: Posts are sorted by date, newest to oldest)")
-        print("-h, --help\tPrint this help text and exit")
-        print("-t, --sort-by-title\tSort posts by title")
-        print("-f, --sort-by-filename\tSort posts by filename")
-        print("-n, --sort-by-number\tSort posts by metadata number (entered in the NUMBER= field of a source file")
-        print("-r, --reversed\tSort posts in reverse order, from lowest to highest / oldest to newest.")
-        print("-c 'path/to/config', --config='path/to/config'\tManually specify the configuration file to be used for this run of the script.")
-        print("-o 'path/to/output/directory', --output='path/to/output/directory'\tManually specify the output directory (Avoid overwriting the contents of the default output directory specified in the configuration file)")
-        print("-a, --absolute-paths\tUse absolute paths (e.g. for <img> src and stylesheet paths) rather than relative paths.")
-        print("--no-subdirs\tDo not create subdirectories in the output directory for each category. All .html files, including categorical pages, are outputted to the root of the output directory.")
-        print("--no-date-hypertext\tDate text (specified in the post template with '(DATE)') will not be hypertext/clickable.")
-        print("--no-title-hypertext\tTitle text (specified in the post template with '(TITLE)') will not be hypertext/clickable.")
-        print("\nFor more information and a user guide, see README.md\nAvailable online at: https://github.com/chsf21/3s/")
-        sys.exit(0)
-    elif option in ("-t", "--sort-by-title"):
-        title_mode = True
-    elif option in ("-n", "--sort-by-number"):
-        number_mode = True
-    elif option in ("-r", "--reversed"):
-        # Reverse mode: First post appears first on the site
-        # Without reverse mode (default): Last post appears first on the site
-        # The value of reverse_mode will be passed into the sort() method's reverse= parameter. Although it may seem counterintuitive, reverse_mode *disables* sort's reverse feature. This is because the default behavior should generate a blog with posts from newest to oldest, which would require the sort() reverse= paramater to be True.
-        reverse_mode = False
-    elif option in ("-f", "--sort-by-filename"):
-        file_mode = True
-    elif option in ("--no-subdirs"):
-        no_subdirs = True
-    elif option in ("--no-date-hypertext"):
-        no_date_hypertext = True
-    elif option in ("--no-title-hypertext"):
-        no_title_hypertext = True
-
-config = os.path.abspath(config)
+# configure() sets every option from a list of command line arguments, then loads the config file and the templates.
+# When this script is imported (e.g. by a long-running build service), configure() can be called again to switch to different options or a different config file. Everything cached from earlier builds is discarded.
+short_options = "htnfrc:o:aij:"
+long_options = ["help", "sort-by-title", "sort-by-number", "sort-by-filename", "reversed", "config=", "output=", "absolute-paths", "no-subdirs", "no-date-hypertext", "no-title-hypertext", "incremental", "jobs=", "atomic", "watch", "port=", "low-memory", "profile=", "profile-render=", "fingerprint-assets", "gzip", "search-index", "url-manifest", "minify", "io-threads=", "links-include=", "lazy-images", "json-pages", "permalinks", "excerpt-length="]
+def configure(args):
+    global configs, reverse_mode, file_mode, number_mode, title_mode, custom_output, absolute_paths, no_subdirs, no_date_hypertext, no_title_hypertext, incremental, jobs, atomic, watch, port, low_memory, profile, profile_render, fingerprint_assets, gzip_pages, search_index, url_manifest, minify, io_threads, links_include, lazy_images, json_pages, permalinks, excerpt_length, output_dir
+    try:
+        arguments, trailing = getopt.getopt(args, short_options, long_options)
+    except getopt.GetoptError as err:
+        print(err)
+        sys.exit(2)
 
-### Import values from config file. 
-if not os.path.isfile(config):
-    print("Config file does not exist. Ensure that the config file, config.ini, is located in the same directory as the generator script. Alternatively, specify the path of the config file using the command line option: --config=[path/to/config] or -c [path/to/config]")
-    sys.exit(2)
+    configs = list()
+
+    reverse_mode = True
+    file_mode = False
+    number_mode = False
+    title_mode = False
+    custom_output = False
+    absolute_paths = False
+    no_subdirs = False
+    no_date_hypertext = False
+    no_title_hypertext = False
+    incremental = False
+    jobs = 1
+    atomic = False
+    watch = False
+    port = 8000
+    low_memory = False
+    profile = None
+    profile_render = None
+    fingerprint_assets = False
+    gzip_pages = False
+    search_index = False
+    url_manifest = False
+    minify = False
+    io_threads = 1
+    links_include = None
+    lazy_images = False
+    json_pages = False
+    permalinks = False
+    excerpt_length = 300
+    for option, value in arguments:
+        if option in ("-c", "--config"):
+            configs.append(os.path.expanduser(value))
+        elif option in ("-a", "--absolute-paths"):
+            absolute_paths = True
+        elif option in ("-o", "--output"):
+            custom_output = True
+            try:
+                os.mkdir(value)
+            except:
+                pass
+            output_dir = os.path.expanduser(value)
+            output_dir = os.path.abspath(output_dir) + "/"
+        elif option in ("-h", "--help"):
+            print("Usage: generator.py [OPTIONS]")
+            print("Options:")
+            print("(DEFAULT: Posts are sorted by date, newest to oldest)")
+            print("-h, --help\tPrint this help text and exit")
+            print("-t, --sort-by-title\tSort posts by title")
+            print("-f, --sort-by-filename\tSort posts by filename")
+            print("-n, --sort-by-number\tSort posts by metadata number (entered in the NUMBER= field of a source file")
+            print("-r, --reversed\tSort posts in reverse order, from lowest to highest / oldest to newest.")
+            print("-c 'path/to/config', --config='path/to/config'\tManually specify the configuration file to be used for this run of the script. Can be given several times to build several sites in one run.")
+            print("-o 'path/to/output/directory', --output='path/to/output/directory'\tManually specify the output directory (Avoid overwriting the contents of the default output directory specified in the configuration file)")
+            print("-a, --absolute-paths\tUse absolute paths (e.g. for <img> src and stylesheet paths) rather than relative paths.")
+            print("--no-subdirs\tDo not create subdirectories in the output directory for each category. All .html files, including categorical pages, are outputted to the root of the output directory.")
+            print("--no-date-hypertext\tDate text (specified in the post template with '(DATE)') will not be hypertext/clickable.")
+            print("--no-title-hypertext\tTitle text (specified in the post template with '(TITLE)') will not be hypertext/clickable.")
+            print("-i, --incremental\tOnly rewrite the pages that are affected by source files that changed since the last incremental run. A build manifest is saved in the output directory to keep track of this.")
+            print("-j N, --jobs=N\tParse and format posts using N processes. Use 0 to use all available processor cores. (Default: 1)")
+            print("--atomic\tBuild the site in a separate staging directory and swap it with the output directory once it is complete. If the output directory is a symlink, the swap is atomic.")
+            print("--watch\tAfter building the site, keep running: serve the output directory on http://127.0.0.1:PORT/ and rebuild the site whenever a source file or template changes. Stop with Ctrl+C.")
+            print("--io-threads=N\tWrite, link and remove files in the output directory with N threads at once. This speeds up builds on network file systems. (Default: 1)")
+            print("--port=N\tThe port used by the preview server of --watch. (Default: 8000)")
+            print("--profile='path/to/report.json'\tSave a report of the build as JSON: the time spent in every phase, counters (files scanned, bytes read, posts formatted, pages written, files deleted, etc.) and peak memory use. Memory tracing slows down the build.")
+            print("--profile-render='path/to/render.prof'\tSave a cProfile profile of formatting posts and writing pages, which can be viewed with the pstats module. With several config files, the name of each config file is added to the path (e.g. report.blog1.json).")
+            print("--fingerprint-assets\tPublish the images of posts and the style sheet to the directory 'assets' in the output directory, under names that contain a hash of their content. Pages link to these files, so that they can be cached indefinitely.")
+            print("--gzip\tSave a compressed copy of every page next to it (.html.gz), for web servers that can send precompressed files. With --fingerprint-assets, the style sheet is compressed as well.")
+            print("--links-include=ssi|fetch\tWrite (CATEGORY_LINKS) and (DATE_LINKS) once to the directory 'includes' in the output directory. Pages include them with a server-side include (ssi) or a script that fetches them (fetch).")
+            print("--json-pages\tAlso save the posts of every page as a JSON file in the directory 'fragments' in the output directory, for loading more posts without loading a whole page.")
+            print("--permalinks\tWrite a page for every post (in the directory 'posts' in the output directory), and show only an excerpt of every post on the other pages, with a link to the page of the post.")
+            print("--excerpt-length=N\tThe number of characters of the body text of a post shown in its excerpt with --permalinks. (Default: 300)")
+            print("--lazy-images\tAdd the width and height of every image to its <img> element (for PNG, JPEG and GIF images), and let browsers load images lazily.")
+            print("--minify\t\tRemove whitespace and comments that do not change how pages look from every page. With --fingerprint-assets, the style sheet is minified as well.")
+            print("--search-index\tSave a search index of all posts as JSON files in the directory 'search' in the output directory, for a search script on the site to use.")
+            print("--url-manifest\tSave a list of every URL of the site with a hash of its content (urls.json), the URLs that were added, changed or removed since the last build (urls_changed.json), and a sitemap (sitemap.xml, if URL is set in the section [Site] of the config file).")
+            print("--low-memory\tOnly keep the metadata of posts in memory. The body text of a post is read and formatted again for every page that it appears on, and each page is written as soon as it is complete. Use this for very large sites.")
+            print("\nFor more information and a user guide, see README.md\nAvailable online at: https://github.com/chsf21/3s/")
+            sys.exit(0)
+        elif option in ("-t", "--sort-by-title"):
+            title_mode = True
+        elif option in ("-n", "--sort-by-number"):
+            number_mode = True
+        elif option in ("-r", "--reversed"):
+            # Reverse mode: First post appears first on the site
+            # Without reverse mode (default): Last post appears first on the site
+            # The value of reverse_mode will be passed into the sort() method's reverse= parameter. Although it may seem counterintuitive, reverse_mode *disables* sort's reverse feature. This is because the default behavior should generate a blog with posts from newest to oldest, which would require the sort() reverse= paramater to be True.
+            reverse_mode = False
+        elif option in ("-f", "--sort-by-filename"):
+            file_mode = True
+        elif option in ("--no-subdirs"):
+            no_subdirs = True
+        elif option in ("--no-date-hypertext"):
+            no_date_hypertext = True
+        elif option in ("--no-title-hypertext"):
+            no_title_hypertext = True
+        elif option in ("-i", "--incremental"):
+            incremental = True
+        elif option in ("-j", "--jobs"):
+            try:
+                jobs = int(value)
+            except ValueError:
+                jobs = -1
+            if jobs < 0:
+                print("The number of jobs must be a whole number. Use 0 to use all available processor cores.")
+                sys.exit(2)
+            if jobs == 0:
+                jobs = os.cpu_count() or 1
+        elif option in ("--atomic",):
+            atomic = True
+        elif option in ("--watch",):
+            watch = True
+        elif option in ("--io-threads",):
+            try:
+                io_threads = int(value)
+            except ValueError:
+                io_threads = 0
+            if io_threads < 1:
+                print("The number of I/O threads must be a whole number of at least 1.")
+                sys.exit(2)
+        elif option in ("--port",):
+            try:
+                port = int(value)
+            except ValueError:
+                port = -1
+            if not 0 <= port <= 65535:
+                print("The port must be a whole number between 0 and 65535.")
+                sys.exit(2)
+        elif option in ("--low-memory",):
+            low_memory = True
+        elif option in ("--profile",):
+            profile = os.path.abspath(os.path.expanduser(value))
+        elif option in ("--profile-render",):
+            profile_render = os.path.abspath(os.path.expanduser(value))
+        elif option in ("--fingerprint-assets",):
+            fingerprint_assets = True
+        elif option in ("--gzip",):
+            gzip_pages = True
+        elif option in ("--links-include",):
+            if value not in ("ssi", "fetch"):
+                print("--links-include must be either 'ssi' or 'fetch'.")
+                sys.exit(2)
+            links_include = value
+        elif option in ("--json-pages",):
+            json_pages = True
+        elif option in ("--permalinks",):
+            permalinks = True
+        elif option in ("--excerpt-length",):
+            try:
+                excerpt_length = int(value)
+            except ValueError:
+                excerpt_length = -1
+            if excerpt_length < 0:
+                print("The excerpt length must be a whole number of characters.")
+                sys.exit(2)
+        elif option in ("--lazy-images",):
+            lazy_images = True
+        elif option in ("--minify",):
+            minify = True
+        elif option in ("--search-index",):
+            search_index = True
+        elif option in ("--url-manifest",):
+            url_manifest = True
+
+    # By default search for config in the same directory as where this script is located.
+    if len(configs) == 0:
+        configs.append(os.path.dirname(os.path.abspath(__file__)) + "/config.ini")
+    configs = [os.path.abspath(path) for path in configs]
+    if len(configs) > 1 and (custom_output or watch):
+        print("-o/--output and --watch can only be used with a single config file.")
+        sys.exit(2)
+    # With several config files, every site saves its own reports (see get_profile_path), named after its config file
+    config_names = [os.path.splitext(os.path.basename(path))[0] for path in configs]
+    if len(configs) > 1 and (profile is not None or profile_render is not None) and len(set(config_names)) < len(config_names):
+        print("--profile and --profile-render can only be used with several config files if the config files have different names, since every site saves its reports under the name of its config file.")
+        sys.exit(2)
+
+    if profile is not None and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    parsed_posts.clear()
+    if len(configs) == 1:
+        select_config(configs[0])
 
-iniparser = configparser.ConfigParser()
-iniparser.read(config)
+# Switch to the site of the config file at path: load the config file and the templates, and discard everything cached for the previous site.
+# Parsed posts are kept, as they are looked up by the path and modification time of their source file. Sites that share source files therefore only parse them once. With -i every site loads its own source index instead.
+def select_config(path):
+    global config
+    config = path
+    load_config()
+    if incremental:
+        parsed_posts.clear()
+    index_changes.clear()
+    formatted_posts_cache.clear()
+    formatted_excerpts_cache.clear()
+    forget_previous_build()
+    load_templates()
 
+### Import values from config file. 
 # Check if the config file is written correctly
 def validate_config(config, section, keys):
     for key in keys:
@@ -102,9 +249,6 @@ def validate_config(config, section, keys):
             print(f"For information on how to set up and write the config file, please see the documentation at: https://github.com/chsf21/3s/")
             sys.exit(2)
 
-# The key "StyleSheet" is optional and is therefore omitted here
-validate_config(config, 'Paths', ['OutputDirectory', 'SourceDirectory', 'PageTemplate', 'PostTemplate', 'NavigationTemplate'])
-
 # Get paths (by expanding them properly into absolute paths). Check if paths specified in config file point to existing files and directories.
 def get_path(config, section, key, item_name, is_directory):
     # If a relative path was written in the config file, interpret it relative to the location of the config file.
@@ -128,17 +272,151 @@ def get_path(config, section, key, item_name, is_directory):
         print(f"\nIf {item_name} does not exist yet, please create it manually.")
         sys.exit(2)
 
-if not custom_output:
-    output_dir = get_path(config, 'Paths', 'OutputDirectory', "output directory", is_directory=True)
-source_dir = get_path(config, 'Paths', 'SourceDirectory', "source directory", is_directory=True)
-page_template = get_path(config, 'Paths', 'PageTemplate', "page template", is_directory=False)
-post_template = get_path(config, 'Paths', 'PostTemplate', "post template", is_directory=False)
-navigation_template = get_path(config, 'Paths', 'NavigationTemplate', "navigation template", is_directory=False)
-stylesheet = get_path(config, 'Paths', 'StyleSheet', "style sheet", is_directory=False)
+def load_config():
+    global iniparser, output_dir, source_dir, page_template, post_template, navigation_template, excerpt_template, stylesheet, manifest_path, index_path, site_url
+    if not os.path.isfile(config):
+        print("Config file does not exist. Ensure that the config file, config.ini, is located in the same directory as the generator script. Alternatively, specify the path of the config file using the command line option: --config=[path/to/config] or -c [path/to/config]")
+        sys.exit(2)
+
+    iniparser = configparser.ConfigParser()
+    iniparser.read(config)
+
+    # The key "StyleSheet" is optional and is therefore omitted here
+    validate_config(config, 'Paths', ['OutputDirectory', 'SourceDirectory', 'PageTemplate', 'PostTemplate', 'NavigationTemplate'])
+
+    if not custom_output:
+        output_dir = get_path(config, 'Paths', 'OutputDirectory', "output directory", is_directory=True)
+    source_dir = get_path(config, 'Paths', 'SourceDirectory', "source directory", is_directory=True)
+    page_template = get_path(config, 'Paths', 'PageTemplate', "page template", is_directory=False)
+    post_template = get_path(config, 'Paths', 'PostTemplate', "post template", is_directory=False)
+    navigation_template = get_path(config, 'Paths', 'NavigationTemplate', "navigation template", is_directory=False)
+    # The key "ExcerptTemplate" is optional. Without it, excerpts (see --permalinks) use the post template.
+    excerpt_template = None
+    if iniparser.has_option('Paths', 'ExcerptTemplate'):
+        excerpt_template = get_path(config, 'Paths', 'ExcerptTemplate', "excerpt template", is_directory=False)
+    stylesheet = get_path(config, 'Paths', 'StyleSheet', "style sheet", is_directory=False)
+    manifest_path = output_dir + ".3s_manifest.json"
+    index_path = output_dir + ".3s_index.sqlite"
+    # The key "URL" in the section "Site" is optional. It is only used for the sitemap (see --url-manifest) and for --links-include
+    site_url = iniparser.get("Site", "URL", fallback="")
+    if site_url != "" and not site_url.endswith("/"):
+        site_url += "/"
+        
+### Functions for --profile
+# The time spent in every phase of a build and counters of the work done are always recorded, as this costs next to nothing. With --profile they are saved as a JSON report after every build.
+# With -j, work that is done by worker processes is counted by the main process when it hands out the work. Memory used by worker processes is not included in peak_memory.
+profile_times = dict()
+profile_counters = dict()
+counter_names = ["files_scanned", "files_parsed", "bytes_read", "template_reads", "posts_formatted", "pages_written", "pages_unchanged", "bytes_written", "pages_compressed", "assets_published", "files_deleted", "directories_deleted"]
+
+# Adds the time since start to phase and returns the current time, which is the start of the next phase.
+def record_phase(phase, start):
+    now = time.perf_counter()
+    profile_times[phase] = profile_times.get(phase, 0.0) + now - start
+    return now
+
+# Counters are also updated by the threads of --io-threads, so they are updated under a lock.
+counter_lock = threading.Lock()
+def count(counter, amount=1):
+    with counter_lock:
+        profile_counters[counter] = profile_counters.get(counter, 0) + amount
+
+### Compile templates
+# Every template is read once and split into segments. Segments with an even index are literal text; segments with an odd index are the names of keywords (e.g. "TITLE" for (TITLE)).
+# Filling in a template is then a single join of its segments, rather than one find and replace over the whole template for every keyword.
+# With --minify, the literal text of every template is minified once here, instead of minifying every page (see minify_html).
+def compile_template(text, keywords):
+    segments = re.split(r"\((" + "|".join(keywords) + r")\)", text)
+    if minify:
+        for index in range(0, len(segments), 2):
+            segments[index] = minify_html(segments[index])
+    return segments
+
+# *values* is a dict with a keyword name as key. If a value is a list, every occurrence of the keyword is filled with the next item in the list (or with the empty string, once the list runs out). This is used for (POST).
+# Keywords that are not in *values* are left as they are.
+def render_template(segments, values):
+    rendered = segments[:]
+    occurrences = dict()
+    for index in range(1, len(rendered), 2):
+        keyword = rendered[index]
+        if keyword not in values:
+            rendered[index] = "(" + keyword + ")"
+        elif isinstance(values[keyword], list):
+            occurrence = occurrences.get(keyword, 0)
+            rendered[index] = values[keyword][occurrence] if occurrence < len(values[keyword]) else ""
+            occurrences[keyword] = occurrence + 1
+        else:
+            rendered[index] = values[keyword]
+    return "".join(rendered)
+
+# Read and compile all templates. This is done by configure(), and again by build() whenever a template changed since it was last read.
+# The first page should not contain hyperlinks for (FIRST) or (PREVIOUS). The last page should not contain hyperlinks for (LAST) or (NEXT).
+# This is done by removing the entire line that contains the keyword. There are only four possible combinations of removed lines, so the navigation_template is compiled once for each of them.
+# navigation_variants is indexed by (is_first_page, is_last_page)
+def load_templates():
+    global page_template_text, post_template_text, navigation_template_text, excerpt_template_text, page_segments, post_segments, excerpt_segments, navigation_variants, posts_per_page, template_stats
+    start = time.perf_counter()
+    template_stats = get_template_stats()
+    page_template_text = read_template(page_template, template_stats[0])
+    post_template_text = read_template(post_template, template_stats[1])
+    navigation_template_text = read_template(navigation_template, template_stats[2])
+    excerpt_template_text = read_template(excerpt_template, template_stats[3]) if excerpt_template is not None else post_template_text
+    page_segments = compile_template(page_template_text, ["POST", "NAVIGATION", "NUMBER", "STYLESHEET", "LABEL", "CATEGORY_LINKS", "DATE_LINKS"])
+    post_segments = compile_template(post_template_text, ["NUMBER", "TITLE", "DATE", "CATEGORIES", "BODY"])
+    excerpt_segments = compile_template(excerpt_template_text, ["NUMBER", "TITLE", "DATE", "CATEGORIES", "BODY", "PERMALINK"])
+    posts_per_page = page_segments[1::2].count("POST")
+
+    nav_dict = dict()
+    nav_dict["first"] = ""
+    nav_dict["previous"] = ""
+    nav_dict["nxt"] = ""
+    nav_dict["last"] = "" 
+    for line in navigation_template_text.splitlines():
+        if "(FIRST)" in line:
+            nav_dict["first"] = line
+            continue
+        elif "(PREVIOUS)" in line:
+            nav_dict["previous"] = line
+            continue
+        elif "(NEXT)" in line:
+            nav_dict["nxt"] = line
+            continue
+        elif "(LAST)" in line:
+            nav_dict["last"] = line
+            continue
+
+    navigation_variants = dict()
+    for is_first_page in (False, True):
+        for is_last_page in (False, True):
+            variant = navigation_template_text
+            if is_first_page:
+                variant = variant.replace(nav_dict["first"], "")
+                variant = variant.replace(nav_dict["previous"], "")
+            if is_last_page:
+                variant = variant.replace(nav_dict["last"], "")
+                variant = variant.replace(nav_dict["nxt"], "")
+            navigation_variants[(is_first_page, is_last_page)] = compile_template(variant, ["FIRST", "PREVIOUS", "NEXT", "LAST"])
+
+    record_phase("templates", start)
+
+# Templates are cached along with their modification time, so that sites that share templates (see build_sites) only read them once.
+template_cache = dict()
+def read_template(path, mtime):
+    if path not in template_cache or template_cache[path][0] != mtime:
+        with open(path, "r") as f:
+            template_cache[path] = (mtime, f.read())
+        count("template_reads")
+        count("bytes_read", len(template_cache[path][1].encode()))
+    return template_cache[path][1]
+
+def get_template_stats():
+    paths = [page_template, post_template, navigation_template]
+    if excerpt_template is not None:
+        paths.append(excerpt_template)
+    return [os.stat(path).st_mtime_ns for path in paths]
 
 ### Create objects for blog posts located in source_dir
 ### Source files will be parsed for metadata and body text, which will then be saved in object properties
-post_objects = list()
 number = 1
 class BlogPost:
     def __init__(self, path, filename, title, date, categories, meta_number, body):
@@ -150,6 +428,7 @@ class BlogPost:
         self.meta_number = meta_number
         self.body = body
         self.number = number
+        self.search_terms = None
 
     # Fix year that was accidentally written as 4 digits instead of 2
     def fix_year(self):
@@ -157,72 +436,98 @@ class BlogPost:
         if len(date_year) == 4:
             self.date[0] = self.date[0][:-4] + date_year[-2:]
 
-# Traverse the source_dir recursively and save files to source_files list
+def is_source_file(filename):
+    return filename.endswith('.txt') and not filename.startswith('.')
+
+# Traverse the source_dir recursively and save the modification time and size of every source file to a dict
 # Symlinks are not followed to prevent an error where os.walk enters an infinite loop
-source_files = list()
-for rootdir, dirnames, filenames in os.walk(source_dir, topdown=True, followlinks=False):
-    for file in filenames:
-        if not file.endswith('.txt') or not file.endswith('') or file.startswith('.'):
-            continue
-        file_path = os.path.join(rootdir, file)
-        source_files.append(file_path)
-
-# Function for pulling metadata out of a source file and saving it to a dict
-def get_value(dictionary, line, source_key, dict_key):
-    if line.startswith(source_key):
-        dictionary[dict_key] = line.removeprefix(source_key)
-        dictionary[dict_key] = dictionary[dict_key].removesuffix('\n')
-        if source_key in ("C=", "CATEGORIES=", "CATEGORY="):
-            dictionary[dict_key] = dictionary[dict_key].split(",")
-        elif source_key == "DATE=":
-            dictionary[dict_key] = dictionary[dict_key].split(" ")
-        return True
-    else:
-        # If no key is found in the source file, then the dictionary key should equal the empty string.
-        # Since setting date to the empty string can cause issues (when trying to convert date into a datetime object for sorting), date will be given a default value when set to the empty string (see below)
-        if dict_key not in dictionary.keys():
-            dictionary[dict_key] = ""
-        return False
+def scan_source_files():
+    source_stats = dict()
+    for rootdir, dirnames, filenames in os.walk(source_dir, topdown=True, followlinks=False):
+        for file in filenames:
+            if not is_source_file(file):
+                continue
+            file_path = os.path.join(rootdir, file)
+            file_stat = os.stat(file_path)
+            source_stats[file_path] = (file_stat.st_mtime_ns, file_stat.st_size)
+    return source_stats
+
+### Parse source files
+# A source file is read all at once. Metadata fields are read from the text before (START), all with one regular expression. If a field is written more than once, the last one counts.
+# The body is the text between (START) and (STOP) (or (END)). (START) must be written at the beginning of a line, but the body may begin right after it. (STOP) may be written at the beginning or at the end of a line. Text after the body is ignored.
+# If a field is missing from the source file, it is left empty. Since an empty date can not be converted into a datetime object for sorting, date will be given a default value (see set_date).
+# With header_only, only the beginning of the file up to (START) is read (see read_source_header), and the body and images are not parsed.
+header_fields = re.compile(r"^(TITLE|C|CATEGORY|CATEGORIES|DATE|NUMBER)=(.*)$", re.MULTILINE)
+body_start = re.compile(r"^\(START\)", re.MULTILINE)
+body_start_bytes = re.compile(rb"^\(START\)", re.MULTILINE)
+body_end = re.compile(r"^\((?:STOP|END)\)|\((?:STOP|END)\)$", re.MULTILINE)
+header_chunk_size = 512
 
-# Go through source file line by line. If metadata is encountered, parse it and save it to a dict. Parse body text.
-in_body = False
-data = dict()
-for file in source_files:
+def parse_header(header):
+    data = {"title": "", "date": "", "categories": list(), "meta_number": ""}
+    for key, value in header_fields.findall(header):
+        if key == "TITLE":
+            data["title"] = value
+        elif key == "DATE":
+            data["date"] = value.split(" ")
+        elif key == "NUMBER":
+            data["meta_number"] = value
+        else:
+            # Empty category names (e.g. from "C=" with no value) are dropped. Otherwise they would produce a category page that overwrites the main index.html
+            data["categories"] = [category for category in value.split(",") if category != ""]
+    return data
+
+# Returns a BlogPost object, or None if the source file is empty.
+def parse_source_file(file, header_only=False):
     if os.path.getsize(file) == 0:
-        continue
-    with open(file, "r") as f:
-        ## Handle errors caused by having two "tags" on the same line
-        ## Print an appropriate error message. If you can, it's even better to make it so that (START) and (STOP) don't need to be on their own lines.
-        for l in f:
-            if l.startswith("(STOP)") or l.startswith("(END)"):
-                in_body = False
-                continue
-            elif l.startswith("(START)"):
-                in_body = True
-                data["body"] = ""
-                continue
-            elif in_body:
-                data["body"] += l
-                continue
-            else:
-                if get_value(data, l, "TITLE=", "title"):
-                    continue
-                elif get_value(data, l, "C=", "categories"):
-                    continue
-                elif get_value(data, l, "CATEGORY=", "categories"):
-                    continue
-                elif get_value(data, l, "CATEGORIES=", "categories"):
-                    continue
-                elif get_value(data, l, "DATE=", "date"):
-                    continue
-                elif get_value(data, l, "NUMBER=", "meta_number"):
-                    continue
-    filename = os.path.basename(file)
-    obj = BlogPost(file, filename, data["title"], data["date"], data["categories"], data["meta_number"], data["body"])
-    post_objects.append(obj)
-    data.clear()
+        return None
+    if header_only:
+        text = read_source_header(file)
+    else:
+        with open(file, "r") as f:
+            text = f.read()
+    start = body_start.search(text)
+    data = parse_header(text if start is None else text[:start.start()])
+    body = ""
+    image_lines = list()
+    if start is not None and not header_only:
+        end = body_end.search(text, start.end())
+        body = text[start.end():len(text) if end is None else end.start()].removeprefix("\n")
+        if "(IMAGE" in body:
+            image_lines = [line for line in body.split("\n") if line.startswith("(IMAGE")]
+    obj = BlogPost(file, os.path.basename(file), data["title"], data["date"], data["categories"], data["meta_number"], None if header_only else body)
+    obj.images = None if header_only else find_images(file, image_lines)
+    return obj
+
+# The file is read in chunks of growing size until (START) is found, so that for most source files only the first few hundred bytes are read.
+# The text is decoded like a file opened with open(file, "r"), including the translation of line endings.
+def read_source_header(file):
+    with open(file, "rb", buffering=0) as f:
+        data = f.read(header_chunk_size)
+        chunk_size = header_chunk_size
+        while True:
+            start = body_start_bytes.search(data)
+            if start is not None:
+                data = data[:start.start()]
+                break
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            data += chunk
+            chunk_size *= 2
+    return io.TextIOWrapper(io.BytesIO(data)).read()
+
+### Functions for spreading work across several processes (-j)
+# Worker processes are forked, so they inherit every global of the script (options, paths, post_objects) at the time the pool is created. Only the arguments and return values of the functions passed to run_jobs have to be sent between processes.
+# Results are returned in the same order as the arguments, so the output is identical to running the function serially.
+def run_jobs(function, arguments):
+    if jobs == 1 or len(arguments) < 2:
+        return [function(argument) for argument in arguments]
+    chunksize = max(1, len(arguments) // (jobs * 4))
+    with multiprocessing.get_context("fork").Pool(jobs) as pool:
+        return pool.map(function, arguments, chunksize)
 
-# Create datetime object for every object in post_objects. Save to obj.date_dt
+# Create datetime object for a post object. Save to obj.date_dt
 # This is later used for sorting by date (if the user chooses to sort by date)
 def default_date(obj):
     print("Could not extract date for source file" + obj.filename + ". Defaulting to 01/01/00 for " + obj.filename + "'s date. No date will be displayed for this post on the generated website.")
@@ -230,7 +535,7 @@ def default_date(obj):
     obj.date_dt = datetime.datetime.strptime("01/01/00", '%m/%d/%y')
     return True
 
-for obj in post_objects:
+def set_date(obj):
     default_date_flag = False
     # If an hour was given for DATE=
     if len(obj.date) == 2:
@@ -265,424 +570,1667 @@ for obj in post_objects:
     if not default_date_flag:
         obj.month_year = obj.date_dt.strftime('%b %Y')
 
+### Functions for the source index (-i)
+# The metadata of every parsed source file (title, date, categories, number, images, search terms) is saved in an SQLite database in the output directory (at index_path, see load_config), along with the modification time, size and content hash of the source file.
+# On the next run with -i, source files whose modification time and size did not change are loaded from the index instead of being read and parsed again. Their body text is only read once the post has to be formatted (see load_body).
+# The index is discarded if the generator script changed, as the parsed metadata may differ.
+index_changes = dict()
+
+def get_generator_hash():
+    with open(os.path.abspath(__file__), "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def load_source_index():
+    indexed_posts = dict()
+    try:
+        db = sqlite3.connect(index_path)
+        try:
+            if db.execute("SELECT value FROM info WHERE key = 'generator'").fetchone() != (get_generator_hash(),):
+                return indexed_posts
+            for path, mtime, size, source_hash, title, date, date_dt, month_year, categories, meta_number, images, search_terms in db.execute("SELECT * FROM posts"):
+                obj = BlogPost(path, os.path.basename(path), title, json.loads(date), json.loads(categories), meta_number, None)
+                obj.images = json.loads(images)
+                obj.search_terms = json.loads(search_terms)
+                obj.date_dt = datetime.datetime.fromisoformat(date_dt)
+                if month_year is not None:
+                    obj.month_year = month_year
+                obj.source_hash = source_hash
+                indexed_posts[path] = ((mtime, size), obj)
+        finally:
+            db.close()
+    except sqlite3.Error:
+        pass
+    return indexed_posts
+
+# Only the rows of source files that were parsed, emptied or removed since the index was last saved are written.
+def save_source_index(source_stats):
+    db = sqlite3.connect(index_path)
+    try:
+        db.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+        generator_hash = get_generator_hash()
+        if db.execute("SELECT value FROM info WHERE key = 'generator'").fetchone() != (generator_hash,):
+            db.execute("DROP TABLE IF EXISTS posts")
+            db.execute("INSERT OR REPLACE INTO info VALUES ('generator', ?)", (generator_hash,))
+        db.execute("CREATE TABLE IF NOT EXISTS posts (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, hash TEXT, title TEXT, date TEXT, date_dt TEXT, month_year TEXT, categories TEXT, meta_number TEXT, images TEXT, search_terms TEXT)")
+        rows = list()
+        for path, obj in index_changes.items():
+            if obj is None:
+                db.execute("DELETE FROM posts WHERE path = ?", (path,))
+            else:
+                mtime, size = source_stats[path]
+                rows.append((path, mtime, size, get_source_hash(obj), obj.title, json.dumps(obj.date), obj.date_dt.isoformat(), getattr(obj, "month_year", None), json.dumps(obj.categories), obj.meta_number, json.dumps(obj.images), json.dumps(obj.search_terms)))
+        db.executemany("INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        # The names of the assets of this build replace those of the last build
+        db.execute("DROP TABLE IF EXISTS assets")
+        db.execute("CREATE TABLE assets (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, minify INTEGER, url TEXT)")
+        db.executemany("INSERT INTO assets VALUES (?, ?, ?, ?, ?)", [(path, *asset_cache[path][0], asset_cache[path][1]) for path in asset_urls])
+        db.commit()
+    finally:
+        db.close()
+    index_changes.clear()
+
+# With --low-memory, only the metadata of posts stays in memory, so only the header of every source file is read. With --fingerprint-assets the images of every post are needed as well, so the whole file is parsed and the body text is dropped right after parsing (within the worker process with -j).
+def parse_source_metadata(file):
+    if reads_headers_only():
+        return parse_source_file(file, header_only=True)
+    obj = parse_source_file(file)
+    if obj is not None and low_memory:
+        obj.body = None
+    return obj
+
+def reads_headers_only():
+    return low_memory and not fingerprint_assets and not lazy_images
+
+# Posts that were loaded from the index (or parsed with --low-memory) have no body text until it is needed.
+def load_body(obj):
+    if obj.body is None:
+        obj.body = parse_source_file(obj.path).body
+
+# Posts whose header was read with header_only do not know their images until they are needed.
+def get_images(obj):
+    if obj.images is None:
+        obj.images = parse_source_file(obj.path).images
+    return obj.images
+
+# With --fingerprint-assets, the names of the published assets are saved in the source index as well, so that assets that did not change are not read and hashed again on the next run with -i (see get_asset_url).
+def load_asset_index():
+    indexed_assets = dict()
+    try:
+        db = sqlite3.connect(index_path)
+        try:
+            if db.execute("SELECT value FROM info WHERE key = 'generator'").fetchone() != (get_generator_hash(),):
+                return indexed_assets
+            for path, mtime, size, minified, url in db.execute("SELECT * FROM assets"):
+                indexed_assets[path] = ((mtime, size, bool(minified)), url)
+        finally:
+            db.close()
+    except sqlite3.Error:
+        pass
+    return indexed_assets
+
+### Parse all source files and return a list of post objects, in the order in which the source files were found.
+# Parsed posts are kept in parsed_posts between builds (in --watch mode), so only source files that were added or changed since the last build are parsed again.
+# With -i, parsed_posts is filled from the source index for the first build.
+parsed_posts = dict()
+def load_posts(source_stats):
+    if incremental and not parsed_posts:
+        parsed_posts.update(load_source_index())
+        for path, cached in load_asset_index().items():
+            asset_cache.setdefault(path, cached)
+        index_changes.update({file: None for file in parsed_posts if parsed_posts[file][0] != source_stats.get(file)})
+    for file in list(parsed_posts.keys()):
+        if file not in source_stats:
+            del parsed_posts[file]
+            formatted_posts_cache.pop(file, None)
+            formatted_excerpts_cache.pop(file, None)
+            if incremental:
+                index_changes[file] = None
+    changed_files = [file for file in source_stats if file not in parsed_posts or parsed_posts[file][0] != source_stats[file]]
+    count("files_parsed", len(changed_files))
+    # Reading only the header of a file is not counted, since the number of bytes read is only known to the worker process
+    if not reads_headers_only():
+        count("bytes_read", sum(source_stats[file][1] for file in changed_files))
+    for file, obj in zip(changed_files, run_jobs(parse_source_metadata, changed_files)):
+        if obj is not None:
+            set_date(obj)
+        parsed_posts[file] = (source_stats[file], obj)
+        formatted_posts_cache.pop(file, None)
+        formatted_excerpts_cache.pop(file, None)
+        if incremental:
+            index_changes[file] = obj
+    return [parsed_posts[file][1] for file in source_stats if parsed_posts[file][1] is not None]
+
 ### Sort post_objects. (Default: By date, newest to oldest. With command line options, it is also possible to sort by filename (-f), title (-t), or meatadata number (-n). These will also be sorted from highest to lowest. To sort from oldest to newest / lowest to highest, use the command line option (-r).
-if file_mode:
-    post_objects.sort(key=attrgetter("filename"), reverse=reverse_mode)
-elif number_mode:
-    post_objects.sort(key=attrgetter("meta_number"), reverse=reverse_mode)
-elif title_mode:
-    post_objects.sort(key=attrgetter("title"), reverse=reverse_mode)
-else:
-    post_objects.sort(key=attrgetter("date_dt"), reverse=reverse_mode)
+def sort_posts(post_objects):
+    if file_mode:
+        post_objects.sort(key=attrgetter("filename"), reverse=reverse_mode)
+    elif number_mode:
+        post_objects.sort(key=attrgetter("meta_number"), reverse=reverse_mode)
+    elif title_mode:
+        post_objects.sort(key=attrgetter("title"), reverse=reverse_mode)
+    else:
+        post_objects.sort(key=attrgetter("date_dt"), reverse=reverse_mode)
 
 ### Assign post numbers to all objects (numbers reflect the actual order of posts in the list post_objects. 
 # This is different from meta_number, which corresponds with the optional "NUMBER=" field in source files. meta_number is used to facilitate sorting by number with -n. If the user does not sort by -n, then meta_number may not represent the actual position of an object in post_objects.)
 # Note: reverse_mode is False when the user selects -r (see above near beginning of file)
-if reverse_mode == False:
-    for obj in post_objects:
-        obj.number = str(number)
-        number += 1
-else:
-    for obj in reversed(post_objects):
-        obj.number = str(number)
-        number += 1
-
-### Functions for handling italics * and bold ** markers.
-### Used later in the function format_post
-def handle_bold(string_as_list, index, bold_encountered_flag, previous_tracker):
-    if string_as_list[index] == "*" and string_as_list[index + 1] == "*":
-        if bold_encountered_flag == False:
-            string_as_list[index] = "<strong>"
-            string_as_list[index + 1] = ""
-            return True, "bold"
-        else:
-            string_as_list[index] = "</strong>"
-            string_as_list[index + 1] = ""
-            return False, "bold"
+def number_posts(post_objects):
+    number = 1
+    if reverse_mode == False:
+        for obj in post_objects:
+            obj.number = str(number)
+            number += 1
     else:
-        return bold_encountered_flag, previous_tracker
-
-def handle_italics(string_as_list, index, italics_encountered_flag, previous_tracker):
-    # If there is a * at the end of a line (string_as_index), it is definitely there to mark italics and not bold (as bold would require two characters: **). This piece of code is necessary, because it allows us to avoid evaluating [index + 1] when at the end of a line, which would return an error.
-    if index == (len(string_as_list) - 1) and string_as_list[index] == "*":
-        if italics_encountered_flag == False:
-            string_as_list[index] = "<em>"
-            return True, "italics"
-        else:
-            string_as_list[index] = "</em>"
-            return False, "italics"
-    elif string_as_list[index] == "*" and not string_as_list[index + 1] == "*":
-        if italics_encountered_flag == False:
-            string_as_list[index] = "<em>"
-            return True, "italics"
+        for obj in reversed(post_objects):
+            obj.number = str(number)
+            number += 1
+
+### Functions for formatting the body of a source file
+# Body text is formatted in a single pass over every line. Only the characters that can start markup (* ` \ and tab) are looked at individually; the text between them is copied over as a whole.
+# Italics are marked with *, bold with ** and code with ```. Inside code, * and ** are ignored until the next ``` is found.
+# A backslash cancels exactly one character in front of it.
+# Whether italics, bold or code are currently open is saved in *state*, since markup may span several lines.
+markup_characters = re.compile(r"[*`\\\t]")
+
+def format_markup(line, state, formatted):
+    position = 0
+    while True:
+        match = markup_characters.search(line, position)
+        if match is None:
+            formatted.append(line[position:])
+            return
+        index = match.start()
+        formatted.append(line[position:index])
+        char = line[index]
+        position = index + 1
+        if char == "\t":
+            formatted.append("&emsp;")
+        elif char == "\\":
+            if index + 1 < len(line):
+                formatted.append("&emsp;" if line[index + 1] == "\t" else line[index + 1])
+                position = index + 2
+            else:
+                formatted.append(char)
+        elif line.startswith("```", index):
+            formatted.append("</code>" if state["code"] else "<code>")
+            state["code"] = not state["code"]
+            position = index + 3
+        elif char == "`" or state["code"]:
+            formatted.append(char)
+        # If three sequential asterisks *** are found, it is ambiguous whether to interpret this as <em><strong> or <strong><em>. This can lead to incorrect HTML nesting. In order to avoid this, the order in which asterisks are replaced depends on whether a bold or italics tag was seen more recently.
+        elif line.startswith("**", index) and not (line.startswith("***", index) and state["previous"] == "italics"):
+            formatted.append("</strong>" if state["bold"] else "<strong>")
+            state["bold"] = not state["bold"]
+            state["previous"] = "bold"
+            position = index + 2
         else:
-            string_as_list[index] = "</em>"
-            return False, "italics"
+            formatted.append("</em>" if state["italics"] else "<em>")
+            state["italics"] = not state["italics"]
+            state["previous"] = "italics"
+
+# If an image's path is given as a relative path, expand it relative to the location of the source file.
+def get_image_path(source_path, image_arg):
+    if image_arg.startswith("/") or image_arg.startswith("~"):
+        return os.path.abspath(os.path.expanduser(image_arg))
+    return os.path.dirname(source_path) + "/" + image_arg
+
+# Returns the paths of the images of the (IMAGE) lines of a source file (see format_image), for --fingerprint-assets. Lines that are written incorrectly are skipped.
+def find_images(source_path, image_lines):
+    images = list()
+    for line in image_lines:
+        image_args = line.replace(link_marker, "").split(" ")
+        if 2 <= len(image_args) <= 3:
+            image_args[-1] = image_args[-1].removesuffix(")")
+            images.append(os.path.normpath(get_image_path(source_path, image_args[1])))
+    return images
+
+# Returns the <img> element for a line starting with (IMAGE, or None if the line is written incorrectly.
+def format_image(obj, line):
+    # Does not literally mean "image arguments". It is a list containing ["(IMAGE", "path/to/image", "id"] (if an id is specified. id is optional.)
+    image_args = line.split(" ")
+
+    if len(image_args) > 3:
+        print(f"Too many arguments given to (IMAGE) in source file {obj.filename}.") 
+        print("Please format (IMAGE) as: (IMAGE path/to/image [id])")
+        print(f"Script will continue anyway. Post for {obj.filename} will not display image correctly.\n")
+        return None
+    elif len(image_args) < 2:
+        print(f"No arguments given to (IMAGE) in source file {obj.filename}.")
+        print("Please format (IMAGE) as: (IMAGE path/to/image [id])")
+        print(f"Script will continue anyway. Post for {obj.filename} will not display image correctly.\n")
+        return None
+
+    image_args[-1] = image_args[-1].removesuffix(")")
+    img_path = get_image_path(obj.path, image_args[1])
+
+    # The relative path depends on the directory of the page that the post is inserted into, so it is left for bind_post to fill in.
+    # With --fingerprint-assets, the name of the published image is only known once the build is under way, so bind_post fills in the path as well.
+    if fingerprint_assets:
+        img_path = link_marker + "A" + os.path.normpath(img_path) + link_marker
+    elif not absolute_paths:
+        img_path = link_marker + "I" + os.path.relpath(img_path, output_dir) + link_marker
+
+    # With --lazy-images, the size of the image is filled in by bind_post, so that a post does not have to be formatted again when only the image changed.
+    attributes = ""
+    if lazy_images:
+        attributes = link_marker + "S" + os.path.normpath(get_image_path(obj.path, image_args[1])) + link_marker + ' loading="lazy" decoding="async"'
+
+    if len(image_args) == 3:
+        return f"</p><img src=\"{img_path}\"{attributes} id=\"{image_args[2]}\"><p>"
     else:
-        return italics_encountered_flag, previous_tracker
-
-def handle_code(string_as_list, index, code_encountered_flag):
-    if string_as_list[index] == "`" and string_as_list[index + 1] == "`" and string_as_list[index + 2] == "`":
-        if code_encountered_flag == False:
-            string_as_list[index] = "<code>"
-            string_as_list[index + 1] = ""
-            string_as_list[index + 2] = ""
-            return True
+        return f"</p><img src=\"{img_path}\"{attributes}><p>"
+
+# Returns the body of obj as HTML. Line breaks become <br> and tabs become &emsp;
+def format_body(obj):
+    state = {"italics": False, "bold": False, "code": False, "previous": "italics"}
+    formatted = list()
+    for line in obj.body.replace(link_marker, "").split("\n"):
+        if line.startswith("(IMAGE"):
+            img_line = format_image(obj, line)
+            if img_line is not None:
+                formatted.append(img_line)
+            else:
+                formatted.append(line.replace("\t", "&emsp;"))
         else:
-            string_as_list[index] = "</code>"
-            string_as_list[index + 1] = ""
-            string_as_list[index + 2] = ""
-            return False
+            format_markup(line, state, formatted)
+        formatted.append("<br>")
+    # The last line of the body is not followed by a line break
+    formatted.pop()
+    return "".join(formatted)
+
+### Function for filling in the keywords of post_template with post object properties. Also formats content within the body of the source file.
+### Returns the formatted post as a list of segments (see bind_post)
+# A post is formatted only once, no matter how many pages it appears on. The only parts of a formatted post that differ between pages are relative links (to category pages, month pages and images), since they depend on the directory where the page resides.
+# These links are marked with link_marker and kept as separate segments. Segments with an even index are HTML; segments with an odd index are links: "L" followed by a path relative to output_dir for links to pages, "I" followed by a path relative to output_dir for images, or "A" followed by the path of an image that is published as an asset.
+# With --lazy-images, "S" followed by the path of an image marks where the width and height of the image are filled in (see find_image_sizes).
+# NUL characters can not appear in HTML, so they are used as link_marker and removed from the source file's text.
+link_marker = "\x00"
+
+def format_post(obj):
+    values = get_post_values(obj)
+    values["BODY"] = format_body(obj)
+    formatted_post = render_template(post_segments, values)
+    if minify:
+        formatted_post = minify_html(formatted_post)
+    return formatted_post.split(link_marker)
+
+# Returns the values of every keyword of the post template except (BODY). With --permalinks, the title links to the page of the post rather than to the post within the current page.
+def get_post_values(obj):
+    values = dict()
+    values["NUMBER"] = obj.number
+    title = obj.title.replace(link_marker, "")
+    if no_title_hypertext:
+        values["TITLE"] = title
+    elif permalinks:
+        values["TITLE"] = '<a href="' + get_permalink_link(obj) + '">' + title + '</a>'
     else:
-        return code_encountered_flag
-
-### Function for finding and replacing tags in post_template with post object properties. Also formats content within the body of the source file.
-### Returns the formatted post as a string
-# page_dir represents the directory where the HTML page that this formatted post will be inserted into will eventually reside.
-def format_post(obj, page_dir):
-    final_location = output_dir + page_dir
-    with open(post_template, "r") as f:
-        temp = f.read()
-        temp = temp.replace("(NUMBER)", obj.number)
-        
-        if no_title_hypertext:
-            temp = temp.replace("(TITLE)", obj.title)
+        values["TITLE"] = '<a href="#' + obj.number + '">' + title + '</a>'
+
+    date_text = " ".join(obj.date).replace(link_marker, "")
+    if hasattr(obj, "month_year") and not no_date_hypertext:
+        month_year_underscore = obj.month_year.replace(" ", "_")
+        if no_subdirs and not absolute_paths:
+            date_hypertext = '<a href="' + month_year_underscore + '.html">' + date_text + '</a>'
+        elif no_subdirs and absolute_paths:
+            date_hypertext = '<a href="' + output_dir + month_year_underscore + '.html">' + date_text + '</a>'
+        elif not no_subdirs and not absolute_paths:
+            date_hypertext = '<a href="' + link_marker + "L" + month_year_underscore + '/index.html' + link_marker + '">' + date_text + '</a>'
         else:
-            temp = temp.replace("(TITLE)", ('<a href="#' + obj.number + '">' + obj.title + '</a>'))
-
-        date_text = " ".join(obj.date)
-        if hasattr(obj, "month_year") and not no_date_hypertext:
-            month_year_underscore = obj.month_year.replace(" ", "_")
-            if no_subdirs and not absolute_paths:
-                date_hypertext = '<a href="' + month_year_underscore + '.html">' + date_text + '</a>'
-            elif no_subdirs and absolute_paths:
-                date_hypertext = '<a href="' + output_dir + month_year_underscore + '.html">' + date_text + '</a>'
-            elif not no_subdirs and not absolute_paths:
-                date_hypertext = '<a href="' + os.path.relpath(output_dir, final_location) + "/" + month_year_underscore + '/index.html">' + date_text + '</a>'
-            else:
-                date_hypertext = '<a href="' + output_dir + month_year_underscore + '/index.html">' + date_text + '</a>'
-            temp = temp.replace("(DATE)", date_hypertext)
+            date_hypertext = '<a href="' + output_dir + month_year_underscore + '/index.html">' + date_text + '</a>'
+        values["DATE"] = date_hypertext
+    else:
+        values["DATE"] = date_text
+
+    categories_hypertext = list()
+    for category in obj.categories:
+        category = category.replace(link_marker, "")
+        if no_subdirs:
+            categories_hypertext.append('<a href="' + category + '.html">' + category + '</a>')
+        elif not absolute_paths:
+            categories_hypertext.append('<a href="' + link_marker + "L" + category + '/index.html' + link_marker + '">' + category + '</a>')
         else:
-            temp = temp.replace("(DATE)", date_text)
+            categories_hypertext.append('<a href="' + output_dir + category + '/index.html">' + category + '</a>')
+    values["CATEGORIES"] = ", ".join(categories_hypertext)
+    return values
+
+### Functions for permalink pages and excerpts (--permalinks)
+# Every post gets a page of its own, named after its source file relative to source_dir (e.g. "posts/2024/trip.html" for "2024/trip.txt"), so the address of a post does not change when other posts are added. With --no-subdirs, the page is written to output_dir instead (e.g. "post_2024_trip.html").
+# The other pages show an excerpt of every post: the excerpt template (or the post template, if the config file does not name one) filled in with the first excerpt_length characters of the body text. (PERMALINK) in the excerpt template is replaced with the link to the page of the post.
+# An excerpt ends after the last whole word that fits, and contains no images. Without an excerpt template, an excerpt that was shortened ends with a link to the page of the post.
+# Italics, bold and code that are still open where the excerpt ends are closed, so that they do not spill over into the rest of the page.
+# Different source files can lead to the same name (e.g. "a b.txt" and "a_b.txt", or "a/b.txt" and "a_b.txt" with --no-subdirs). Source files are therefore named in the order of their paths, and a name that is already taken gets a number (e.g. "posts/a_b_2.html").
+permalink_names = dict()
 
-        categories_hypertext = list()
+def plan_permalinks(post_objects):
+    permalink_names.clear()
+    taken = set()
+    for path in sorted(obj.path for obj in post_objects):
+        name = os.path.relpath(path, source_dir).removesuffix(".txt").replace(" ", "_")
         if no_subdirs:
-            for category in obj.categories:
-                categories_hypertext.append('<a href="' + category + '.html">' + category + '</a>')
+            name = "post_" + name.replace("/", "_")
         else:
-            for category in obj.categories:
-                if not absolute_paths:
-                    categories_hypertext.append('<a href="' + os.path.relpath(output_dir, final_location) + "/" + category + '/index.html">' + category + '</a>')
-                else:
-                    categories_hypertext.append('<a href="' + output_dir + category + '/index.html">' + category + '</a>')
-        temp = temp.replace("(CATEGORIES)", ", ".join(categories_hypertext))
-        temp_body = obj.body
-    # Process formatting within the body of the source file
-    italics_encountered = False
-    bold_encountered = False 
-    code_encountered = False 
-    previous_bold_or_italics = "italics"
-    for line in temp_body.splitlines():
+            name = "posts/" + name
+        permalink = name + ".html"
+        number = 2
+        while permalink in taken:
+            permalink = name + "_" + str(number) + ".html"
+            number += 1
+        taken.add(permalink)
+        permalink_names[path] = permalink
+
+def get_permalink(obj):
+    return permalink_names[obj.path]
+
+def get_permalink_link(obj):
+    if absolute_paths:
+        return output_dir + get_permalink(obj)
+    if no_subdirs:
+        return get_permalink(obj)
+    return link_marker + "L" + get_permalink(obj) + link_marker
+
+def format_excerpt(obj):
+    values = get_post_values(obj)
+    values["PERMALINK"] = get_permalink_link(obj)
+    values["BODY"], shortened = format_excerpt_body(obj)
+    if shortened and excerpt_template is None:
+        values["BODY"] += ' <a href="' + values["PERMALINK"] + '">Read more</a>'
+    formatted_excerpt = render_template(excerpt_segments, values)
+    if minify:
+        formatted_excerpt = minify_html(formatted_excerpt)
+    return formatted_excerpt.split(link_marker)
+
+# Returns the excerpt as HTML, and whether anything of the body was left out.
+def format_excerpt_body(obj):
+    state = {"italics": False, "bold": False, "code": False, "previous": "italics"}
+    formatted = list()
+    length = 0
+    shortened = False
+    for line in obj.body.replace(link_marker, "").split("\n"):
         if line.startswith("(IMAGE"):
-            # Does not literally mean "image arguments". It is a list containing ["(IMAGE", "path/to/image", "id"] (if an id is specified. id is optional.)
-            image_args = line.split(" ")
+            shortened = True
+            continue
+        if len(formatted) > 0:
+            formatted.append("<br>")
+        if length + len(line) > excerpt_length:
+            end = line.rfind(" ", 0, excerpt_length - length + 1)
+            format_markup(line[:end].rstrip() if end > 0 else line[:excerpt_length - length], state, formatted)
+            formatted.append("&hellip;")
+            shortened = True
+            break
+        format_markup(line, state, formatted)
+        length += len(line)
+    if state["code"]:
+        formatted.append("</code>")
+    closing_tags = ["</strong>", "</em>"] if state["previous"] == "bold" else ["</em>", "</strong>"]
+    for tag in closing_tags:
+        if state["bold" if tag == "</strong>" else "italics"]:
+            formatted.append(tag)
+    return "".join(formatted), shortened
 
-            if len(image_args) > 3:
-                print(f"Too many arguments given to (IMAGE) in source file {obj.filename}.") 
-                print("Please format (IMAGE) as: (IMAGE path/to/image [id])")
-                print("Script will continue anyway. Post for {obj.filename} will not display image correctly.\n")
-                continue
-            elif len(image_args) < 2:
-                print(f"No arguments given to (IMAGE) in source file {obj.filename}.")
-                print("Please format (IMAGE) as: (IMAGE path/to/image [id])")
-                print("Script will continue anyway. Post for {obj.filename} will not display image correctly.\n")
-                continue
+### Fill in the links of a post formatted by format_post, for a page that resides in page_dir (a subdirectory of output_dir, or "" for output_dir itself).
+# Subdirectories can be nested if a category contains a "/", so link prefixes are computed once for every directory depth and reused.
+link_prefixes = dict()
+def get_link_prefix(depth):
+    if depth not in link_prefixes:
+        link_prefixes[depth] = "/".join([".."] * depth) if depth > 0 else "."
+    return link_prefixes[depth]
 
-            image_args[-1] = image_args[-1].removesuffix(")")
-            # If an image's path is given as a relative path, expand it relative to the location of the source file.
-            if image_args[1].startswith("/") or image_args[1].startswith("~"):
-                img_path = os.path.expanduser(image_args[1])
-                img_path = os.path.abspath(img_path)
-            else:
-                img_path = os.path.dirname(obj.path) + "/" + image_args[1]
-
-            if not absolute_paths:
-                img_path = os.path.relpath(img_path, final_location)
-            
-            if len(image_args) == 3:
-                img_line = f"</p><img src=\"{img_path}\" id=\"{image_args[2]}\"><p>"
-                temp_body = temp_body.replace(line, img_line)
-            else:
-                img_line = f"</p><img src=\"{img_path}\"><p>"
-                temp_body = temp_body.replace(line, img_line)
+def get_depth(page_dir):
+    return os.path.normpath(page_dir).count("/") + 1 if page_dir != "" else 0
+
+def bind_post(formatted_post, page_dir):
+    if len(formatted_post) == 1:
+        return formatted_post[0]
+    page_dir = os.path.normpath(page_dir) if page_dir != "" else ""
+    depth = get_depth(page_dir)
+    prefix = get_link_prefix(depth)
+    bound = formatted_post[:]
+    for index in range(1, len(bound), 2):
+        link_type = bound[index][0]
+        target = bound[index][1:]
+        if link_type == "S":
+            bound[index] = image_size_attributes.get(target, "")
             continue
+        # Published assets are linked like images. An image that does not exist is linked at its original location.
+        if link_type == "A":
+            if absolute_paths:
+                bound[index] = output_dir + asset_urls[target] if target in asset_urls else target
+                continue
+            target = asset_urls[target] if target in asset_urls else os.path.relpath(target, output_dir)
+        if link_type == "L":
+            bound[index] = prefix + "/" + target
+        elif depth == 0:
+            bound[index] = target
+        # An image inside the page's own directory is linked to directly, rather than by leaving the directory and entering it again.
+        elif target.startswith(page_dir + "/"):
+            bound[index] = os.path.relpath(output_dir + target, output_dir + page_dir)
         else:
-            # Interpreting * and ** as italics and bold tags respectively
-            # Code is marked with ```. If an opening tag for code is found, * and ** will be ignored until the next ``` is found.
-            ## Add continue statements here (?) Or maybe that is redundant, since the whole thing is built with if and else statements, and adding continues will make the code less readable.
-            formatted_line = list(line)
-            for char_num in range(len(formatted_line)):
-                if char_num > 0 and formatted_line[char_num - 1] == "\\":
-                    formatted_line[char_num - 1] = ""
-                # The last character of a line can not possibly be a bold tag because bold tags are two characters: **
-                elif char_num == (len(formatted_line) - 1) and not code_encountered:
-                    italics_encountered, previous_bold_or_italics = handle_italics(formatted_line, char_num, italics_encountered, previous_bold_or_italics)
-                # Similarly the second-to-last character of a line can not possibly be a code tag because code tags are three characters: ``
-                elif char_num == (len(formatted_line) - 2) and not code_encountered:
-                    italics_encountered, previous_bold_or_italics = handle_italics(formatted_line, char_num, italics_encountered, previous_bold_or_italics)
-                    bold_encountered, previous_bold_or_italics = handle_bold(formatted_line, char_num, bold_encountered, previous_bold_or_italics)
-                else:
-                    if code_encountered:
-                        code_encountered = handle_code(formatted_line, char_num, code_encountered)
-                        continue
-                    # If three sequential asterisks *** are found, it is ambiguous whether to interpret this as <em><strong> or <strong><em>. This can lead to incorrect HTML nesting. In order to this, the order in which asterisks are replaced should depend on whether a bold or italics tag was seen more recently.
-                    elif formatted_line[char_num] == "*" and formatted_line[char_num + 1] == "*" and formatted_line[char_num + 2] == "*":
-                        if previous_bold_or_italics == "italics":
-                            # The function handle_italics isn't used here, as it will not trigger, since the * is followed by an *.
-                            # Instead of using handle_italics, the * is replaced manually.
-                            if italics_encountered == False:
-                                formatted_line[char_num] = "<em>"
-                                italics_encountered = True
-                                previous_bold_or_italics = "italics"
-                            else:
-                                formatted_line[char_num] = "</em>"
-                                italics_encountered = False
-                                previous_bold_or_italics = "italics"
-                        else:
-                            bold_encountered, previous_bold_or_italics = handle_bold(formatted_line, char_num, bold_encountered, previous_bold_or_italics)
-                    else:
-                        code_encountered = handle_code(formatted_line, char_num, code_encountered)
-                        italics_encountered, previous_bold_or_italics = handle_italics(formatted_line, char_num, italics_encountered, previous_bold_or_italics)
-                        bold_encountered, previous_bold_or_italics = handle_bold(formatted_line, char_num, bold_encountered, previous_bold_or_italics)
-            temp_body = temp_body.replace(line, ''.join(formatted_line))
-    temp_body = temp_body.replace("\n", "<br>")
-    temp_body = temp_body.replace("\t", "&emsp;")
-    temp = temp.replace("(BODY)", temp_body) 
-    return temp
-
-### Insert formatted posts (returned by format_post) into page_template. Create a new page when necessary.
+            bound[index] = prefix + "/" + target
+    return "".join(bound)
+
+### Divide posts into pages. Every list of posts (all posts, the posts of a category, the posts of a month) is split into chunks of posts_per_page posts. Each chunk will become one .html page.
 # *first_page_filename* should be a the filename of the .html file to be generated. For example: "index"
 # *subsequent_page_filename* should be the filename of all subsequently generated .html files. 
 # These files will look like: subsequent_page_filename[page_count].html
 # page_count starts at 2, as it will only be used for the purpose of providing a page number afer subsequent_page_filename
 # *subdir* should be the subdirectory within the output_dir where generated .html files should be output.
 # If no subdirectory is desired, use the empty string "" for subdir.
-# *formatted_posts* should be a list of posts that were already formatted by the function format_post.
+# *posts* should be a list of post objects.
+# Returns the list of paths of the pages and a list containing the post objects of each page.
 
-def insert_posts(first_page_filename, subsequent_page_filename, subdir, formatted_posts):
+def plan_pages(first_page_filename, subsequent_page_filename, subdir, posts):
     subdir = subdir.replace(" ", "_")
     first_page_filename = first_page_filename.replace(" ", "_")
     subsequent_page_filename = subsequent_page_filename.replace(" ", "_")
-    page_count = 2
-    post_count = 0
     if (no_subdirs == False) and (subdir != ""):
-        if os.path.isdir(output_dir + subdir):
-            pass
-        else:
-            os.mkdir(output_dir + subdir)
         subdir = subdir + "/"
     else:
         subdir = ""
-    current_page = shutil.copyfile(page_template, output_dir + subdir + first_page_filename + ".html")
-    page_list = list()
-    page_list.append(current_page)
-    while post_count <= len(formatted_posts):
-        with open(page_template, "r") as f:
-            contents = f.read()
-            posts_per_page = contents.count("(POST)")
-        for x in range(posts_per_page):
-            if post_count == len(formatted_posts):
-                contents = contents.replace("(POST)", "")
-                break
-            contents = contents.replace("(POST)", formatted_posts[post_count], 1)
-            post_count += 1
-        with open(current_page, "w") as f:
-            f.write(contents)
-        if post_count == len(formatted_posts):
-            break
-        else:
-            new_page = output_dir + subdir + subsequent_page_filename + "_" + str(page_count) + ".html"
-            current_page = shutil.copyfile(page_template, new_page)
-            page_list.append(new_page)
-            page_count += 1
-    return page_list
-
-### Loop through every object in post_objects. For each object, format it using format_posts. 
-# All formatted posts are appended to the list all_formatted_posts
-# Formatted posts with categories are appended to a list of formatted posts for that specific category.
-# Categorical lists of formatted posts are contained within the dictionary category_formatted_posts
-# If subdirectories will be used, we can make assumptions about where the final generated pages will be located (page_dir), as subdirectories only go one level deep and are named after the category or date.
-all_formatted_posts = list()
-category_formatted_posts = dict()
-date_formatted_posts = dict()
-for obj in post_objects:
-    page_dir = ""
-    formatted_post = format_post(obj, page_dir)
-    all_formatted_posts.append(formatted_post)
-    for category in obj.categories:
-        if not no_subdirs:
-            page_dir = category
-            formatted_post = format_post(obj, page_dir)
-        try:
-            category_formatted_posts[category].append(formatted_post)
-        except:
-            category_formatted_posts[category] = list()
-            category_formatted_posts[category].append(formatted_post)
-    if hasattr(obj, "month_year"):
-        if not no_subdirs:
-            page_dir = obj.month_year
-            formatted_post = format_post(obj, page_dir)
-        try:
-            date_formatted_posts[obj.month_year].append(formatted_post)
-        except:
-            date_formatted_posts[obj.month_year] = list()
-            date_formatted_posts[obj.month_year].append(formatted_post)
+    page_list = [output_dir + subdir + first_page_filename + ".html"]
+    page_posts = [posts[:posts_per_page]]
+    # If the page template contains no (POST), a single page without posts is generated
+    if posts_per_page > 0:
+        for start in range(posts_per_page, len(posts), posts_per_page):
+            page_count = len(page_list) + 1
+            page_list.append(output_dir + subdir + subsequent_page_filename + "_" + str(page_count) + ".html")
+            page_posts.append(posts[start:start + posts_per_page])
+    return page_list, page_posts
 
-### Remove any .html files that are currently in the output directory and its subdirectories that were not created during this run of the script. 
-### This is to provide "overwrite" functionality.
-for dirpath, dirnames, filenames in os.walk(output_dir):
-    for file in filenames:
-        if file.endswith(".html"):
-            os.remove(os.path.join(dirpath, file))
-# If any directory is empty after this "overwrite", remove the directory.
-for dirpath, dirnames, filenames in os.walk(output_dir):
-    for dirname in dirnames:
-        path = os.path.join(dirpath, dirname)
-        if len(os.listdir(path)) == 0:
-            os.rmdir(path)
-
-### Call insert_posts to generate .html pages in output_dir for every post. Save list of paths of generated pages.
-# Generate main pages (contain all posts)
-main_pages = insert_posts("index", "page", "", all_formatted_posts)
-
-# Generate categorial pages and date pages.
-def insert_posts_from_dict(dictionary):
-    pages_dict = dict()
+### Plan all pages. Main pages contain all posts. Categorical pages and date pages contain the posts of one category or month.
+# Posts with categories are appended to a list of posts for that specific category.
+# Categorical lists of posts are contained within the dictionary category_posts. Lists of posts for every month are contained within date_posts.
+# Every entry of listings is: (page_list, page_posts, page_dir, subdir, label)
+# page_dir is passed to bind_post. If subdirectories will be used, we can make assumptions about where the final generated pages will be located (page_dir), as subdirectories only go one level deep and are named after the category or date.
+def plan_listings(post_objects):
+    category_posts = dict()
+    date_posts = dict()
+    for obj in post_objects:
+        for category in obj.categories:
+            try:
+                category_posts[category].append(obj)
+            except:
+                category_posts[category] = list()
+                category_posts[category].append(obj)
+        if hasattr(obj, "month_year"):
+            try:
+                date_posts[obj.month_year].append(obj)
+            except:
+                date_posts[obj.month_year] = list()
+                date_posts[obj.month_year].append(obj)
+
+    main_pages, main_page_posts = plan_pages("index", "page", "", post_objects)
+    listings = [(main_pages, main_page_posts, "", "", "")]
+    category_links = plan_pages_from_dict(category_posts, listings)
+    date_links = plan_pages_from_dict(date_posts, listings)
+    # With --permalinks, every post also gets a page of its own, labeled with the title of the post
+    if permalinks:
+        plan_permalinks(post_objects)
+        for obj in post_objects:
+            page_dir = os.path.dirname(get_permalink(obj))
+            listings.append(([output_dir + get_permalink(obj)], [[obj]], page_dir, page_dir, obj.title.replace(link_marker, "")))
+    return listings, main_pages, category_links, date_links
+
+def plan_pages_from_dict(dictionary, listings):
     links_dict = dict()
     for key in dictionary:
         if no_subdirs:
             first_page_name = key
+            page_dir = ""
         else:
             first_page_name = "index"
-        try:
-            pages_dict[key] += insert_posts(first_page_name, key, key, dictionary[key])
-        except:
-            pages_dict[key] = insert_posts(first_page_name, key, key, dictionary[key])
-            links_dict[key] = pages_dict[key][0]
-    return pages_dict, links_dict
-
-category_pages, category_links = insert_posts_from_dict(category_formatted_posts)
-date_pages, date_links = insert_posts_from_dict(date_formatted_posts)
-
-### Format the navigation_template
-# Parse the navigation_template
-with open(navigation_template, "r") as f:
-    navigation = f.read()
-nav_dict = dict()
-nav_dict["first"] = ""
-nav_dict["previous"] = ""
-nav_dict["nxt"] = ""
-nav_dict["last"] = "" 
-for line in navigation.splitlines():
-    if "(FIRST)" in line:
-        nav_dict["first"] = line
-        continue
-    elif "(PREVIOUS)" in line:
-        nav_dict["previous"] = line
-        continue
-    elif "(NEXT)" in line:
-        nav_dict["nxt"] = line
-        continue
-    elif "(LAST)" in line:
-        nav_dict["last"] = line
-        continue
-
-
-# Format the navigation_template appropriately for page_list[page_number]
-def format_navigation(page_list, page_numbers, page_number, nav_string, nav_dict):
-    formatted_nav = nav_string
-    # Remove necessary lines from the formatted navigation_template
-    # The first page should not contain hyperlinks for (FIRST) or (PREVIOUS)
-    # The last page should not contain hyperlinks for (LAST) or (NEXT)
-    first_page = False
-    last_page = False
-    if page_number == 0:
-        formatted_nav = formatted_nav.replace(nav_dict["first"], "")
-        formatted_nav = formatted_nav.replace(nav_dict["previous"], "")
-        first_page = True
-    if page_number == page_numbers[-1]:
-        formatted_nav = formatted_nav.replace(nav_dict["last"], "")
-        formatted_nav = formatted_nav.replace(nav_dict["nxt"], "")
-        last_page = True
-
-    # Replace keywords in navigation_template with appropriate values
-    if not first_page:
+            page_dir = key
+        page_list, page_posts = plan_pages(first_page_name, key, key, dictionary[key])
+        listings.append((page_list, page_posts, page_dir, key.replace(" ", "_"), key))
+        links_dict[key] = page_list[0]
+    return links_dict
+
+### Functions for incremental builds (-i)
+# The build manifest is saved in the output directory (at manifest_path, see load_config). For every source file it records the content hash that was last seen, along with the pages that the source file feeds (its main page, its category pages and its month page).
+# For every page it records a signature of everything that went into that page. Pages whose signature did not change since the last run are not rendered or written again.
+
+# Anything that affects every page at once (the generator itself, the templates, the command line options) is hashed into one signature. If it differs from the signature saved in the manifest, the manifest is discarded and every page is rebuilt.
+def get_settings_signature():
+    settings_hash = hashlib.sha1()
+    with open(os.path.abspath(__file__), "rb") as f:
+        settings_hash.update(f.read())
+    for text in (page_template_text, post_template_text, navigation_template_text, excerpt_template_text):
+        settings_hash.update(text.encode())
+    options = [output_dir, stylesheet, reverse_mode, file_mode, number_mode, title_mode, absolute_paths, no_subdirs, no_date_hypertext, no_title_hypertext, fingerprint_assets, gzip_pages, minify, links_include, site_url, lazy_images, json_pages, permalinks, excerpt_length]
+    settings_hash.update(json.dumps(options).encode())
+    return settings_hash.hexdigest()
+
+def load_manifest(settings_signature):
+    try:
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("settings") != settings_signature:
+        return None
+    return manifest
+
+# Source files are only read and hashed if they were parsed during this run. Posts loaded from the source index (or kept in memory by --watch) already carry the hash of their unchanged source file.
+def get_source_hash(obj):
+    if not hasattr(obj, "source_hash"):
+        with open(obj.path, "rb") as f:
+            data = f.read()
+        obj.source_hash = hashlib.sha1(data).hexdigest()
+        count("bytes_read", len(data))
+    return obj.source_hash
+
+def get_page_signature(page_list, page_number, page_posts, page_dir, label, links_signature):
+    neighbors = [page_list[0], page_list[max(page_number - 1, 0)], page_list[min(page_number + 1, len(page_list) - 1)], page_list[-1]]
+    posts = [(obj.path, obj.source_hash, obj.number, get_permalink(obj) if permalinks else None, [(asset_urls.get(image), image_size_attributes.get(image)) for image in get_images(obj)] if fingerprint_assets or lazy_images else None) for obj in page_posts[page_number]]
+    data = json.dumps([page_list[page_number], len(page_list), neighbors, page_dir, label, posts, links_signature])
+    return hashlib.sha1(data.encode()).hexdigest()
+
+### Determine which pages have to be written during this build, by comparing the signature of every page with its signature from the previous build.
+# Returns the set of pages to be written, along with the record of this build (saved as the manifest with -i).
+def find_dirty_pages(previous_build, settings_signature):
+    old_sources = previous_build["sources"] if previous_build else dict()
+    old_pages = previous_build["pages"] if previous_build else dict()
+    new_sources = dict()
+    changed_sources = 0
+    for obj in post_objects:
+        source_hash = get_source_hash(obj)
+        if obj.path not in old_sources or old_sources[obj.path]["hash"] != source_hash:
+            changed_sources += 1
+        new_sources[obj.path] = {"hash": source_hash, "pages": list()}
+
+    # With --links-include, pages no longer contain the lists of links, so adding a category or a month does not change them
+    if links_include is not None:
+        links_signature = [asset_urls.get(stylesheet)]
+    else:
+        links_signature = [main_pages[0], list(category_links.items()), list(date_links.items()), asset_urls.get(stylesheet)]
+    new_pages = dict()
+    dirty_pages = set()
+    for page_list, page_posts, page_dir, subdir, label in listings:
+        for page_number in range(len(page_list)):
+            page = page_list[page_number]
+            new_pages[page] = get_page_signature(page_list, page_number, page_posts, page_dir, label, links_signature)
+            if old_pages.get(page) != new_pages[page] or not os.path.isfile(page):
+                dirty_pages.add(page)
+            for obj in page_posts[page_number]:
+                new_sources[obj.path]["pages"].append(page)
+    print(f"Incremental build: {changed_sources} of {len(post_objects)} source files changed. Writing {len(dirty_pages)} of {len(all_pages)} pages.")
+    return dirty_pages, {"settings": settings_signature, "sources": new_sources, "pages": new_pages}
+
+### Format posts using format_post. Every post is only formatted once, and only if it appears on a page that will be written.
+# Formatted posts are kept in formatted_posts_cache along with their post number (see get_format_key). In --watch mode, a post is only formatted again if its source file or its number changed.
+# With --permalinks, the excerpts of posts are formatted the same way, and kept in formatted_excerpts_cache.
+# With -j the posts are formatted by several processes at once.
+formatted_posts_cache = dict()
+formatted_excerpts_cache = dict()
+def format_dirty_posts():
+    render_indexes = {False: list(), True: list()}
+    seen = set()
+    for page_list, page_posts, page_dir, subdir, label in listings:
+        for page_number in range(len(page_list)):
+            if page_list[page_number] not in dirty_pages:
+                continue
+            excerpts = shows_excerpts(page_list[page_number])
+            for obj in page_posts[page_number]:
+                if (obj.path, excerpts) in seen:
+                    continue
+                seen.add((obj.path, excerpts))
+                cached = get_formatted_cache(excerpts).get(obj.path)
+                if cached is None or cached[0] != get_format_key(obj):
+                    render_indexes[excerpts].append(post_index[obj.path])
+                    if obj.body is None:
+                        count("bytes_read", parsed_posts[obj.path][0][1])
+    count("posts_formatted", len(render_indexes[False]) + len(render_indexes[True]))
+
+    for excerpts, function in ((False, render_post), (True, render_excerpt)):
+        cache = get_formatted_cache(excerpts)
+        for index, formatted_post in zip(render_indexes[excerpts], run_jobs(function, render_indexes[excerpts])):
+            cache[post_objects[index].path] = (get_format_key(post_objects[index]), formatted_post)
+
+# A formatted post depends on its number, and with --permalinks on the name of its page
+def get_format_key(obj):
+    return (obj.number, permalink_names.get(obj.path) if permalinks else None)
+
+def render_post(index):
+    load_body(post_objects[index])
+    return format_post(post_objects[index])
+
+def render_excerpt(index):
+    load_body(post_objects[index])
+    return format_excerpt(post_objects[index])
+
+def get_formatted_cache(excerpts):
+    return formatted_excerpts_cache if excerpts else formatted_posts_cache
+
+# Pages of posts (see --permalinks) show the whole post. With --permalinks, every other page shows excerpts.
+def shows_excerpts(page):
+    return permalinks and page not in permalink_pages
+
+# With --low-memory, posts are not formatted ahead of time. Instead, every post is formatted for each page that it appears on, while that page is assembled, and its body text is dropped again right after.
+def get_formatted_post(obj, excerpts=False):
+    if not low_memory:
+        return get_formatted_cache(excerpts)[obj.path][1]
+    count("posts_formatted")
+    count("bytes_read", parsed_posts[obj.path][0][1])
+    load_body(obj)
+    formatted_post = format_excerpt(obj) if excerpts else format_post(obj)
+    obj.body = None
+    return formatted_post
+
+### Format the navigation_template appropriately for page_list[page_number]
+def format_navigation(page_list, page_number):
+    is_first_page = page_number == 0
+    is_last_page = page_number == len(page_list) - 1
+    values = dict()
+    if not is_first_page:
         if absolute_paths:
-            previous_page = page_list[page_number - 1]
-            first_page = page_list[0]
+            values["PREVIOUS"] = page_list[page_number - 1]
+            values["FIRST"] = page_list[0]
         else:
-            previous_page = os.path.basename(page_list[page_number - 1])
-            first_page = os.path.basename(page_list[0])
-        new_previous = nav_dict["previous"].replace("(PREVIOUS)", previous_page)
-        formatted_nav = formatted_nav.replace(nav_dict["previous"], new_previous)
-        new_first = nav_dict["first"].replace("(FIRST)", first_page)
-        formatted_nav = formatted_nav.replace(nav_dict["first"], new_first)
-    if not last_page:
+            values["PREVIOUS"] = os.path.basename(page_list[page_number - 1])
+            values["FIRST"] = os.path.basename(page_list[0])
+    if not is_last_page:
         if absolute_paths:
-            next_page = page_list[page_number + 1]
-            last_page = page_list[-1] 
+            values["NEXT"] = page_list[page_number + 1]
+            values["LAST"] = page_list[-1]
         else:
-            next_page = os.path.basename(page_list[page_number + 1])
-            last_page = os.path.basename(page_list[-1])
-        new_nxt = nav_dict["nxt"].replace("(NEXT)", next_page)
-        formatted_nav = formatted_nav.replace(nav_dict["nxt"], new_nxt)
-        new_last = nav_dict["last"].replace("(LAST)", last_page)
-        formatted_nav = formatted_nav.replace(nav_dict["last"], new_last)
-    return formatted_nav
-
-### Find and replace for all remaining keywords on page_template
+            values["NEXT"] = os.path.basename(page_list[page_number + 1])
+            values["LAST"] = os.path.basename(page_list[-1])
+    return render_template(navigation_variants[(is_first_page, is_last_page)], values)
+
+### Fill in all remaining keywords on page_template
 # Replace (NAVIGATION) in the page_template with the result of format_navigation
 # Replace (NUMBER) in the page_template with the current page number
 # Replace (STYLESHEET) in the page_template with the absolute path of the style sheet that was specified in the config file
 # Replace (CATEGORY) with the current page's category if applicable. Otherwise replace it with "All Posts".
 # Replace (CATEGORY_LINKS) with links to all of the first pages of each category.
 # Replace (DATE_LINKS) in a similar way to (CATEGORY_LINKS), except the pages represent months rather than categories 
-def format_links(links_dict, beginning_link):
-    links = "<ul>"
-    links = links + beginning_link
-    for key in links_dict:
-        links = links + '<li><a href="' + links_dict[key] + '">' + key + '</a></li>'
-        if key == list(links_dict.keys())[-1]:
-            return (links + "</ul>")
-
-def final_process_pages(page_list, subdir, label, category_links, date_links,  main_pages, stylesheet):
-    page_numbers = range(len(page_list))
+# The lists of links are the same on every page, except that relative links depend on how deep the directory of the page is. They are therefore formatted once for every directory depth and reused (see get_link_lists).
+# With --links-include, the lists are instead written once to the directory "includes" in output_dir, and pages only contain a reference to them (see write_link_includes).
+link_lists = dict()
+include_files = set()
+
+# *prefix* is put in front of the paths of pages relative to output_dir. If it is None, the absolute paths of pages are used.
+def format_links(links_dict, beginning_link, prefix):
+    links = ["<ul>", beginning_link]
+    for key, page in links_dict.items():
+        links.append('<li><a href="' + get_page_link(page, prefix) + '">' + key + '</a></li>')
+    links.append("</ul>")
+    return "".join(links)
+
+def get_page_link(page, prefix):
+    if prefix is None:
+        return page
+    return prefix + page.removeprefix(output_dir)
+
+def format_link_lists(prefix):
+    beginning_link = '<li><a href="' + get_page_link(main_pages[0], prefix) + '">All Posts</a></li>'
+    return format_links(category_links, beginning_link, prefix), format_links(date_links, "", prefix)
+
+# Returns the values of (CATEGORY_LINKS) and (DATE_LINKS) for a page in page_dir.
+def get_link_lists(page_dir):
+    if links_include is not None:
+        key = "include"
+    elif absolute_paths:
+        key = "absolute"
+    else:
+        key = get_depth(page_dir)
+    if key not in link_lists:
+        if links_include is not None:
+            link_lists[key] = (get_include_reference("category_links.html"), get_include_reference("date_links.html"))
+        elif absolute_paths:
+            link_lists[key] = format_link_lists(None)
+        else:
+            link_lists[key] = format_link_lists(get_link_prefix(key) + "/")
+    return link_lists[key]
+
+### Functions for --links-include
+# The links in the files in "includes" start at the root of the site (e.g. "/dogs/index.html"), so that they work from every page. If the site is not at the root of its domain, the path of URL in the section [Site] of the config file is used instead of "/" (e.g. "/blog/" for https://example.com/blog/).
+# With "ssi", pages contain an include directive for the web server (e.g. "ssi on;" with nginx, or mod_include with Apache). With "fetch", pages contain a placeholder and a short script that replaces it with the fetched list.
+def get_site_path():
+    site_path = urllib.parse.urlparse(site_url).path if site_url != "" else "/"
+    return site_path if site_path.endswith("/") else site_path + "/"
+
+def get_include_reference(name):
+    url = get_site_path() + "includes/" + name
+    if links_include == "ssi":
+        return '<!--#include virtual="' + url + '" -->'
+    return '<span data-include="' + url + '"></span><script>(s=>fetch(s.dataset.include).then(r=>r.text()).then(t=>s.outerHTML=t))(document.currentScript.previousElementSibling)</script>'
+
+def write_link_includes():
+    include_files.clear()
+    if links_include is None:
+        return
+    category_html, date_html = format_link_lists(get_site_path())
+    for name, data in (("category_links.html", category_html), ("date_links.html", date_html)):
+        path = output_dir + "includes/" + name
+        include_files.add(path)
+        data = data.encode(output_encoding)
+        record_url(path, data)
+        submit_write(publish_file, path, data)
+
+### Functions for publishing files to output_dir
+# A file is only replaced if its content changed. Unchanged files keep their modification time and inode, so rsync, CDNs and browsers (If-Modified-Since) only see the pages that really changed.
+# A changed file is first written to a temporary file next to it and then renamed over the old file, so that a reader never sees a half-written page.
+# With --atomic, files are instead published to staging_dir, a copy of output_dir that replaces output_dir once the whole site is complete (see swap_staging_dir).
+output_encoding = locale.getpreferredencoding(False)
+
+def get_staged_path(path):
+    if atomic:
+        return staging_dir + path.removeprefix(output_dir)
+    return path
+
+def file_has_content(path, data):
+    try:
+        if os.path.getsize(path) != len(data):
+            return False
+        with open(path, "rb") as f:
+            return f.read() == data
+    except OSError:
+        return False
+
+# Returns True if the file was written, or False if it was left unchanged.
+def publish_file(path, data):
+    staged_path = get_staged_path(path)
+    if not os.path.isdir(os.path.dirname(staged_path)):
+        os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+    if file_has_content(path, data):
+        if atomic:
+            link_or_copy(path, staged_path)
+        return False
+    temp_path = os.path.join(os.path.dirname(staged_path), "." + os.path.basename(staged_path) + ".tmp")
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, staged_path)
+    return True
+
+### Functions for writing files with several threads (--io-threads)
+# With --io-threads, writing pages, publishing assets, removing old files and (with --atomic) carrying over files are handed to a pool of threads, so that on network file systems many file operations can wait for the server at once.
+# Directories are created by the threads as well, when the first file inside them is written (see publish_file).
+# At most io_threads * 4 operations are waiting at any time, so that pages that were assembled faster than they can be written do not pile up in memory.
+# Errors are collected and reported once all waiting operations are done (see flush_writes). Without --io-threads, every operation is done right away.
+writer_pool = None
+writer_jobs = list()
+writer_slots = None
+
+def start_writing():
+    global writer_pool, writer_slots
+    stop_writing()
+    if io_threads > 1:
+        writer_pool = concurrent.futures.ThreadPoolExecutor(io_threads)
+        writer_slots = threading.BoundedSemaphore(io_threads * 4)
+
+def submit_write(function, *args):
+    if writer_pool is None:
+        function(*args)
+        return
+    writer_slots.acquire()
+    job = writer_pool.submit(function, *args)
+    job.add_done_callback(lambda job: writer_slots.release())
+    writer_jobs.append(job)
+
+def flush_writes():
+    errors = [job.exception() for job in writer_jobs if job.exception() is not None]
+    writer_jobs.clear()
+    if len(errors) > 0:
+        stop_writing()
+        print("Could not write " + str(len(errors)) + " file(s) in the output directory:")
+        for error in errors:
+            print(error)
+        sys.exit(2)
+
+def stop_writing():
+    global writer_pool
+    if writer_pool is None:
+        return
+    flush_writes()
+    writer_pool.shutdown()
+    writer_pool = None
+
+# Hard links keep the inode and modification time of unchanged files. If hard links are not possible (e.g. across file systems), the file is copied along with its metadata.
+def link_or_copy(path, staged_path):
+    if os.path.islink(path):
+        os.symlink(os.readlink(path), staged_path)
+        return
+    try:
+        os.link(path, staged_path)
+    except OSError:
+        shutil.copy2(path, staged_path)
+
+# The staging directory is created next to the directory that output_dir points to, so that it is on the same file system and can be renamed into place.
+def create_staging_dir():
+    output_path = output_dir.rstrip("/")
+    real_output_path = os.path.realpath(output_path)
+    staging_path = tempfile.mkdtemp(prefix=os.path.basename(output_path) + ".", dir=os.path.dirname(real_output_path))
+    os.chmod(staging_path, stat.S_IMODE(os.stat(real_output_path).st_mode))
+    return staging_path + "/"
+
+def carry_over_files():
+    for dirpath, dirnames, filenames in os.walk(output_dir):
+        # Symlinks to directories are not entered by os.walk, so the symlink itself is carried over
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            staged_path = get_staged_path(path)
+            if name in dirnames and not os.path.islink(path):
+                continue
+            if is_old_file(path) or os.path.lexists(staged_path):
+                continue
+            if not os.path.isdir(os.path.dirname(staged_path)):
+                os.makedirs(os.path.dirname(staged_path))
+            submit_write(link_or_copy, path, staged_path)
+
+# If output_dir is a symlink, a new symlink pointing to staging_dir atomically replaces it, and the directory it pointed to before is removed.
+# Otherwise output_dir is renamed out of the way and staging_dir is renamed to output_dir. There is a very short moment in between where output_dir does not exist.
+def swap_staging_dir():
+    output_path = output_dir.rstrip("/")
+    staging_path = staging_dir.rstrip("/")
+    if os.path.islink(output_path):
+        old_path = os.path.realpath(output_path)
+        if os.path.isabs(os.readlink(output_path)):
+            new_target = staging_path
+        else:
+            new_target = os.path.relpath(staging_path, os.path.dirname(output_path))
+        temp_link = output_path + ".tmp"
+        if os.path.lexists(temp_link):
+            os.remove(temp_link)
+        os.symlink(new_target, temp_link)
+        os.replace(temp_link, output_path)
+    else:
+        old_path = staging_path + ".old"
+        os.rename(output_path, old_path)
+        os.rename(staging_path, output_path)
+    shutil.rmtree(old_path)
+
+### Functions for publishing assets (--fingerprint-assets)
+# The images of posts and the stylesheet are published to the directory "assets" in output_dir, under a name that contains a hash of their content (e.g. assets/photo.3f2a9c81d04e.jpg). Pages link to these files instead of the original files. A changed file gets a new name, so the published files never change and can be cached indefinitely.
+# Assets are hard linked from their original location if possible (copied otherwise), and only published if a file of that name does not exist yet.
+# The names of assets are cached along with the modification time and size of the original file, so that unchanged files are not hashed again. With -i, they are also saved in the source index (see load_asset_index).
+# asset_urls maps the path of every asset of the current build to its path relative to output_dir. published_assets contains the same paths relative to output_dir.
+asset_cache = dict()
+asset_urls = dict()
+published_assets = set()
+asset_name = re.compile(r"\.[0-9a-f]{12}(\.[^./]*)?(\.gz)?$")
+
+def get_asset_url(path):
+    try:
+        path_stat = os.stat(path)
+    except OSError:
+        return None
+    key = (path_stat.st_mtime_ns, path_stat.st_size, minify)
+    if path not in asset_cache or asset_cache[path][0] != key:
+        with open(path, "rb") as f:
+            data = f.read()
+        count("bytes_read", len(data))
+        # A minified style sheet is named after the hash of its minified content
+        if minify and path.endswith(".css"):
+            data = minify_stylesheet(data)
+        stem, extension = os.path.splitext(os.path.basename(path))
+        asset_cache[path] = (key, "assets/" + stem + "." + hashlib.sha1(data).hexdigest()[:12] + extension)
+    return asset_cache[path][1]
+
+def find_assets():
+    asset_urls.clear()
+    published_assets.clear()
+    if not fingerprint_assets:
+        return
+    for path in [stylesheet] + [image for obj in post_objects for image in get_images(obj)]:
+        if path not in asset_urls:
+            url = get_asset_url(path)
+            if url is not None:
+                asset_urls[path] = url
+                published_assets.add(url)
+
+# Images with the same name and content in different directories share one published file, which is only published once.
+def publish_assets():
+    submitted_urls = set()
+    for path, url in asset_urls.items():
+        if url in submitted_urls:
+            continue
+        submitted_urls.add(url)
+        if not os.path.exists(output_dir + url):
+            submit_write(publish_asset, path, url)
+        # With --gzip, stylesheets are compressed as well. Images are already compressed.
+        if gzip_pages and url.endswith(".css") and not os.path.exists(output_dir + url + ".gz"):
+            submit_write(compress_asset, path, url)
+
+def read_asset(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    if minify and path.endswith(".css"):
+        return minify_stylesheet(data)
+    return data
+
+def publish_asset(path, url):
+    if minify and path.endswith(".css"):
+        publish_file(output_dir + url, read_asset(path))
+    else:
+        # The asset is linked or copied to a temporary file first, so that an interrupted copy never leaves a truncated file under the final name, which would never be replaced
+        staged_path = get_staged_path(output_dir + url)
+        if not os.path.isdir(os.path.dirname(staged_path)):
+            os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+        temp_path = os.path.join(os.path.dirname(staged_path), "." + os.path.basename(staged_path) + ".tmp")
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        link_or_copy(os.path.realpath(path), temp_path)
+        os.replace(temp_path, staged_path)
+    count("assets_published")
+
+def compress_asset(path, url):
+    compress_file(output_dir + url, read_asset(path))
+
+# Published assets that are no longer used by any page are removed (or not carried over with --atomic), as are all of them without --fingerprint-assets. Only files named like assets are removed from the directory "assets".
+def is_old_asset(path):
+    if not path.startswith(output_dir + "assets/") or asset_name.search(path) is None:
+        return False
+    if path.endswith(".gz"):
+        return not gzip_pages or path.removeprefix(output_dir)[:-3] not in published_assets
+    return path.removeprefix(output_dir) not in published_assets
+
+### Functions for the sizes of images (--lazy-images)
+# The width and height of PNG, JPEG and GIF images are read from the first bytes of the image file. Sizes are cached along with the modification time and size of the image file, so an image is only read again if it changed.
+# The attributes for every image used in this build are collected in image_size_attributes before the pages are generated, and filled in by bind_post. Images whose size can not be read only get loading="lazy" and decoding="async".
+image_size_cache = dict()
+image_size_attributes = dict()
+
+def find_image_sizes():
+    image_size_attributes.clear()
+    if not lazy_images:
+        return
+    for obj in post_objects:
+        for path in get_images(obj):
+            if path not in image_size_attributes:
+                size = get_image_size(path)
+                image_size_attributes[path] = f' width="{size[0]}" height="{size[1]}"' if size is not None else ""
+
+def get_image_size(path):
+    try:
+        path_stat = os.stat(path)
+    except OSError:
+        return None
+    key = (path_stat.st_mtime_ns, path_stat.st_size)
+    if path not in image_size_cache or image_size_cache[path][0] != key:
+        try:
+            with open(path, "rb") as f:
+                size = read_image_size(f)
+        except (OSError, struct.error):
+            size = None
+        image_size_cache[path] = (key, size)
+    return image_size_cache[path][1]
+
+# Returns (width, height), or None if the file is not a PNG, JPEG or GIF image.
+def read_image_size(f):
+    header = f.read(26)
+    if header.startswith(b"\x89PNG\r\n\x1a\n") and header[12:16] == b"IHDR":
+        return struct.unpack(">II", header[16:24])
+    if header[:6] in (b"GIF87a", b"GIF89a"):
+        return struct.unpack("<HH", header[6:10])
+    if header.startswith(b"\xff\xd8"):
+        f.seek(2)
+        return read_jpeg_size(f)
+    return None
+
+# A JPEG file is a sequence of segments, each starting with a marker. The size is found in the "start of frame" segment (markers C0 to CF, except C4, C8 and CC).
+# Photos taken with a rotated camera are stored sideways, with an Exif orientation (5 to 8) that tells the browser to rotate them. Width and height are then swapped, since browsers display them rotated.
+def read_jpeg_size(f):
+    swapped = False
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        # Markers may be preceded by any number of fill bytes (0xFF)
+        while marker[1] == 0xFF:
+            marker = marker[1:] + f.read(1)
+            if len(marker) < 2:
+                return None
+        if marker[1] in (0xD8, 0x01) or 0xD0 <= marker[1] <= 0xD7:
+            continue
+        if marker[1] in (0xD9, 0xDA):
+            return None
+        length = struct.unpack(">H", f.read(2))[0]
+        if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">xHH", f.read(5))
+            return (height, width) if swapped else (width, height)
+        segment = f.read(length - 2)
+        if marker[1] == 0xE1 and segment.startswith(b"Exif\x00\x00"):
+            swapped = get_exif_orientation(segment[6:]) in (5, 6, 7, 8)
+
+# Returns the orientation (tag 0x0112 of the first image file directory) of Exif data, or None.
+def get_exif_orientation(tiff):
+    if tiff[:2] == b"II":
+        order = "<"
+    elif tiff[:2] == b"MM":
+        order = ">"
+    else:
+        return None
+    try:
+        offset = struct.unpack(order + "I", tiff[4:8])[0]
+        entries = struct.unpack(order + "H", tiff[offset:offset + 2])[0]
+        for entry in range(entries):
+            start = offset + 2 + entry * 12
+            tag, value = struct.unpack(order + "H6xH", tiff[start:start + 10])
+            if tag == 0x0112:
+                return value
+    except struct.error:
+        return None
+    return None
+
+### Functions for the search index (--search-index)
+# The search index is saved as JSON files in the directory "search" in output_dir, for a search script on the site to download.
+# search/index.json describes how the index is split: {"prefix_length": 2, "posts_per_file": 1000}
+# The title and the URL (relative to output_dir) of every post are saved by post number, posts_per_file posts per file: posts 0 to 999 in search/posts/0.json, posts 1000 to 1999 in search/posts/1.json, and so on: {"1": ["Title", "index.html#1"], ...}. With --permalinks, the URL is that of the page of the post.
+# A search only downloads the files of the posts it shows, so the size of a search does not grow with the number of posts.
+# Every term is saved in a shard named after its first prefix_length characters (e.g. the term "static" in search/st.json), so that a search only downloads the shards of the terms it looks for.
+# A shard maps each of its terms to the numbers of the posts that contain it, in ascending order. Each number is saved as the difference to the number before it to keep the files small: {"static": [3, 1, 10]} stands for posts 3, 4 and 14.
+# The terms of a post are the words (of at least two letters or digits) of its title, categories and body text, in lowercase. They are kept with the post object (and saved in the source index with -i), so only new and changed posts are split into terms again.
+# Shards whose content did not change are not written again (see publish_file).
+search_prefix_length = 2
+search_posts_per_file = 1000
+search_word = re.compile(r"\w\w+")
+search_files = set()
+# Only files named like the files of the search index are removed from the directory "search" (see is_old_file), so that other files can be kept there
+search_file_name = re.compile(r"search/(?:\w{" + str(search_prefix_length) + r"}|index|posts/\d+)\.json")
+
+def find_search_terms(index):
+    obj = post_objects[index]
+    body = obj.body if obj.body is not None else parse_source_file(obj.path).body
+    text = obj.title + "\n" + "\n".join(obj.categories) + "\n" + "\n".join(line for line in body.split("\n") if not line.startswith("(IMAGE"))
+    return sorted(set(search_word.findall(text.lower())))
+
+def write_search_index():
+    search_files.clear()
+    if not search_index:
+        return
+    missing_indexes = [index for index in range(len(post_objects)) if post_objects[index].search_terms is None]
+    count("bytes_read", sum(parsed_posts[post_objects[index].path][0][1] for index in missing_indexes if post_objects[index].body is None))
+    for index, search_terms in zip(missing_indexes, run_jobs(find_search_terms, missing_indexes)):
+        obj = post_objects[index]
+        obj.search_terms = search_terms
+        if incremental:
+            index_changes[obj.path] = obj
+
+    shards = dict()
+    for obj in sorted(post_objects, key=lambda obj: int(obj.number)):
+        number = int(obj.number)
+        for term in obj.search_terms:
+            shard = shards.setdefault(term[:search_prefix_length], dict())
+            if term in shard:
+                shard[term].append(number)
+            else:
+                shard[term] = [number]
+
+    post_files = dict()
+    main_pages, main_page_posts = listings[0][0], listings[0][1]
+    for page_number in range(len(main_pages)):
+        page_url = main_pages[page_number].removeprefix(output_dir)
+        for obj in main_page_posts[page_number]:
+            posts = post_files.setdefault(int(obj.number) // search_posts_per_file, dict())
+            posts[obj.number] = [obj.title.replace(link_marker, ""), get_permalink(obj) if permalinks else page_url + "#" + obj.number]
+    publish_search_file("index", {"prefix_length": search_prefix_length, "posts_per_file": search_posts_per_file})
+    for file_number, posts in post_files.items():
+        publish_search_file("posts/" + str(file_number), posts)
+
+    for prefix, shard in shards.items():
+        for term, numbers in shard.items():
+            shard[term] = [numbers[0]] + [numbers[index] - numbers[index - 1] for index in range(1, len(numbers))]
+        publish_search_file(prefix, shard)
+
+def publish_search_file(name, data):
+    path = output_dir + "search/" + name + ".json"
+    search_files.add(path)
+    data = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    record_url(path, data)
+    submit_write(publish_file, path, data)
+
+### Functions for the URL manifest, the sitemap and the list of changed URLs (--url-manifest)
+# urls.json in output_dir maps every URL of the site (relative to output_dir) to a hash of its content (the ETag) and the time its content last changed: {"index.html": {"etag": "3f2a9c81d04e", "lastmod": "2024-05-01T12:00:00+00:00"}, ...}
+# urls_changed.json lists the URLs that were added, changed or removed since the last build: {"added": [...], "changed": [...], "removed": [...]}. A deploy script can use it to purge only those URLs from a CDN.
+# sitemap.xml lists every page along with its lastmod. It is only written if the config file sets the URL of the site.
+# Pages, shards of the search index and the sitemap are hashed when they are generated. Pages that were not generated again (see find_dirty_pages) keep the hash from the last urls.json. Published assets use the hash in their name.
+url_hashes = dict()
+
+def record_url(path, data):
+    if url_manifest:
+        url_hashes[path.removeprefix(output_dir)] = hashlib.sha1(data).hexdigest()[:12]
+
+def load_url_manifest():
+    try:
+        with open(output_dir + "urls.json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+def write_url_manifest():
+    if not url_manifest:
+        return
+    previous_urls = load_url_manifest()
+    for page in all_pages | fragment_files:
+        url = page.removeprefix(output_dir)
+        if url in url_hashes:
+            continue
+        if url in previous_urls:
+            url_hashes[url] = previous_urls[url]["etag"]
+        else:
+            with open(page, "rb") as f:
+                record_url(page, f.read())
+    for url in published_assets:
+        url_hashes[url] = asset_name.search(url).group(0)[1:13]
+
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+    urls = dict()
+    changes = {"added": [], "changed": [], "removed": []}
+    # The sitemap is hashed after the lastmod of every page is known, so it is added to urls last
+    for url in sorted(url_hashes):
+        urls[url] = get_url_entry(url, url_hashes[url], previous_urls, now, changes)
+    if site_url != "":
+        sitemap = ['<?xml version="1.0" encoding="UTF-8"?>', '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">']
+        for url in sorted(page.removeprefix(output_dir) for page in all_pages):
+            sitemap.append("<url><loc>" + html.escape(site_url + urllib.parse.quote(url)) + "</loc><lastmod>" + urls[url]["lastmod"] + "</lastmod></url>")
+        sitemap.append("</urlset>\n")
+        data = "\n".join(sitemap).encode("utf-8")
+        record_url(output_dir + "sitemap.xml", data)
+        publish_file(output_dir + "sitemap.xml", data)
+        urls["sitemap.xml"] = get_url_entry("sitemap.xml", url_hashes["sitemap.xml"], previous_urls, now, changes)
+    changes["removed"] = sorted(url for url in previous_urls if url not in urls)
+    changes["added"].sort()
+    changes["changed"].sort()
+    publish_file(output_dir + "urls.json", json.dumps(urls, indent=1, sort_keys=True).encode("utf-8"))
+    publish_file(output_dir + "urls_changed.json", json.dumps(changes, indent=1).encode("utf-8"))
+
+# A URL keeps its lastmod as long as its hash does not change.
+def get_url_entry(url, etag, previous_urls, now, changes):
+    if url not in previous_urls:
+        changes["added"].append(url)
+    elif previous_urls[url]["etag"] != etag:
+        changes["changed"].append(url)
+    else:
+        return previous_urls[url]
+    return {"etag": etag, "lastmod": now}
+
+### Functions for minifying pages and the style sheet (--minify)
+# Runs of whitespace are replaced by a single space, and removed entirely next to tags of block elements, where they never show. Comments are removed, except for conditional comments (<!--[if ...]>).
+# The content of <pre>, <code> (including ``` code blocks of posts), <textarea>, <script> and <style> is left as it is. An element that is not closed is left as it is until the end of the text.
+# Only spaces, tabs and line breaks count as whitespace, so non-breaking spaces (and &emsp; from tabs) are kept.
+# Pages are not minified as a whole. Instead the templates are minified once when they are compiled (see compile_template), and every post once when it is formatted, so the cost does not grow with the number of pages a post appears on.
+minify_protected = re.compile(r"(<(pre|code|textarea|script|style)\b.*?(?:</\2\s*>|\Z))", re.DOTALL | re.IGNORECASE)
+html_comment = re.compile(r"<!--(?!\[if).*?-->", re.DOTALL)
+html_whitespace = re.compile(r"[ \t\n\r\f]+")
+block_tags = r"</?(?:!doctype|html|head|body|title|meta|link|div|p|ul|ol|li|dl|dt|dd|h[1-6]|hr|br|table|thead|tbody|tfoot|tr|td|th|header|footer|nav|main|section|article|aside|blockquote|figure|figcaption|form)\b"
+# Spaces before and after block tags are removed separately, as both patterns then start with a literal character that the regex engine can search for quickly
+space_before_block_tag = re.compile(r" (?=" + block_tags + ")", re.IGNORECASE)
+space_after_block_tag = re.compile("(" + block_tags + r"[^>]*>) ", re.IGNORECASE)
+
+def minify_html(text):
+    parts = minify_protected.split(text)
+    minified = list()
+    # Every match adds two parts (the element and its name) after the text before it
+    for index in range(0, len(parts), 3):
+        part = html_whitespace.sub(" ", html_comment.sub("", parts[index]))
+        minified.append(space_after_block_tag.sub(r"\1", space_before_block_tag.sub("", part)))
+        if index + 1 < len(parts):
+            minified.append(parts[index + 1])
+    return "".join(minified)
+
+# Comments are removed and whitespace is removed around braces, semicolons, commas, ">" and after colons. Strings are left as they are.
+css_string_or_comment = re.compile(r"(\"(?:\\.|[^\"\\])*\"|'(?:\\.|[^'\\])*')|/\*.*?\*/", re.DOTALL)
+css_space = re.compile(r"\s*([{};,>])\s*|(:)\s+")
+
+def minify_css(text):
+    parts = css_string_or_comment.split(text)
+    minified = list()
+    for index in range(0, len(parts), 2):
+        minified.append(css_space.sub(r"\1\2", html_whitespace.sub(" ", parts[index])).replace(";}", "}"))
+        if index + 1 < len(parts) and parts[index + 1] is not None:
+            minified.append(parts[index + 1])
+    return "".join(minified).strip()
+
+def minify_stylesheet(data):
+    return minify_css(data.decode("utf-8", "surrogateescape")).encode("utf-8", "surrogateescape")
+
+### Functions for compressed copies of pages (--gzip)
+# A compressed copy of a page is saved next to it (page.html.gz) whenever the page is written, or if the compressed copy does not exist yet. Web servers that support it (e.g. nginx with gzip_static) send the compressed copy instead of compressing the page for every request.
+# With -j, pages are compressed by a pool of threads while the next pages are assembled (zlib does not hold the GIL while compressing).
+# mtime=0 keeps the compressed copy of a page the same as long as the page is the same.
+compression_pool = None
+compression_jobs = list()
+
+def compress_file(path, data):
+    publish_file(path + ".gz", gzip.compress(data, 9, mtime=0))
+
+def compress_page(path, data):
+    count("pages_compressed")
+    if compression_pool is None:
+        compress_file(path, data)
+    else:
+        compression_jobs.append(compression_pool.submit(compress_file, path, data))
+
+def start_compression():
+    global compression_pool
+    if gzip_pages and jobs > 1:
+        compression_pool = concurrent.futures.ThreadPoolExecutor(jobs)
+
+def finish_compression():
+    global compression_pool
+    if compression_pool is None:
+        return
+    try:
+        for job in compression_jobs:
+            job.result()
+    finally:
+        compression_jobs.clear()
+        compression_pool.shutdown()
+        compression_pool = None
+
+# Returns True for files in output_dir that were not generated during this build: old pages, compressed copies of old pages (or of any page without --gzip), old JSON fragments, old files of the search index, old assets, and the URL manifest and sitemap. Files of an option that is turned off are old as well. These are removed (or not carried over with --atomic).
+def is_old_file(path):
+    if path.startswith(output_dir + "fragments/") and (path.endswith(".json") or path.endswith(".json.gz")):
+        if path.endswith(".gz"):
+            return not gzip_pages or path[:-3] not in fragment_files
+        return path not in fragment_files
+    if path.endswith(".html"):
+        return path not in all_pages and path not in include_files
+    if path.endswith(".html.gz"):
+        return not gzip_pages or path[:-3] not in all_pages
+    if search_file_name.fullmatch(path.removeprefix(output_dir)) is not None:
+        return path not in search_files
+    if path in (output_dir + "urls.json", output_dir + "urls_changed.json"):
+        return not url_manifest
+    if path == output_dir + "sitemap.xml":
+        return not url_manifest or site_url == ""
+    return is_old_asset(path)
+
+### Functions for JSON fragments of pages (--json-pages)
+# Every page also gets a JSON fragment with its posts, so that a script on the site can load more posts (e.g. while scrolling) without loading the whole page again.
+# The fragment of a page is saved under the directory "fragments" in output_dir, at the same path as the page (e.g. "fragments/dogs/page_2.json" for "dogs/page_2.html"):
+# {"number": 2, "pages": 5, "page": "../../dogs/page_2.html", "previous": "index.json", "next": "dogs_3.json", "posts": ["<div class=\"post\">...</div>", ...]}
+# "page", "previous" and "next" are relative to the fragment (or absolute with -a). "previous" and "next" are null on the first and last page.
+# The posts are the same HTML that is inserted into the page, with links that are relative to the directory of the page. They are written along with the page, so a fragment is only written again when its page is.
+fragment_files = set()
+
+def get_fragment_path(page):
+    return output_dir + "fragments/" + page.removeprefix(output_dir).removesuffix(".html") + ".json"
+
+def write_fragment(page_list, page_number, posts):
+    fragment = get_fragment_path(page_list[page_number])
+    fragment_dir = os.path.dirname(fragment)
+    def get_fragment_link(path):
+        return path if absolute_paths else os.path.relpath(path, fragment_dir)
+    data = dict()
+    data["number"] = page_number + 1
+    data["pages"] = len(page_list)
+    data["page"] = get_fragment_link(page_list[page_number])
+    data["previous"] = get_fragment_link(get_fragment_path(page_list[page_number - 1])) if page_number > 0 else None
+    data["next"] = get_fragment_link(get_fragment_path(page_list[page_number + 1])) if page_number < len(page_list) - 1 else None
+    data["posts"] = posts
+    data = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    record_url(fragment, data)
+    submit_write(publish_fragment, fragment, data)
+
+# With --gzip, fragments are compressed like pages, but are not counted as compressed pages.
+def publish_fragment(path, data):
+    if publish_file(path, data):
+        if gzip_pages:
+            compress_file(path, data)
+    elif gzip_pages and not os.path.exists(path + ".gz"):
+        compress_file(path, data)
+
+### Assemble every page planned by plan_pages in memory and write it to output_dir. Every page is written exactly once.
+# Fill in (POST) with formatted posts (returned by format_post), with their links bound to the directory of the page.
+# Only pages contained in dirty_pages are written.
+def write_pages(page_list, page_posts, page_dir, subdir, label):
     if no_subdirs:
         subdir = ""
+    page_stylesheet = stylesheet
+    if stylesheet in asset_urls:
+        page_stylesheet = output_dir + asset_urls[stylesheet]
     if not absolute_paths:
-        stylesheet = os.path.relpath(stylesheet, output_dir + subdir)
-    for page_number in page_numbers:
-        with open(page_list[page_number], "r") as f:
-            contents = f.read()
-
-        contents = contents.replace("(NAVIGATION)", format_navigation(page_list, page_numbers, page_number, navigation, nav_dict))
-        contents = contents.replace("(NUMBER)", str(page_number + 1))
-        contents = contents.replace("(STYLESHEET)", stylesheet)
+        page_stylesheet = os.path.relpath(page_stylesheet, output_dir + subdir)
+    for page_number in range(len(page_list)):
+        page = page_list[page_number]
+        if page not in dirty_pages:
+            continue
 
+        values = dict()
+        excerpts = shows_excerpts(page)
+        values["POST"] = [bind_post(get_formatted_post(obj, excerpts), page_dir) for obj in page_posts[page_number]]
+        if json_pages:
+            write_fragment(page_list, page_number, values["POST"])
+        values["NAVIGATION"] = format_navigation(page_list, page_number)
+        values["NUMBER"] = str(page_number + 1)
+        values["STYLESHEET"] = page_stylesheet
         if label != "":
-            contents = contents.replace("(LABEL)", label)
+            values["LABEL"] = label
+        else:
+            values["LABEL"] = "All Posts"
+        values["CATEGORY_LINKS"], values["DATE_LINKS"] = get_link_lists(page_dir)
+
+        data = render_template(page_segments, values).encode(output_encoding)
+        record_url(page, data)
+        submit_write(write_page, page, data)
+
+def write_page(page, data):
+    if publish_file(page, data):
+        count("pages_written")
+        count("bytes_written", len(data))
+        if gzip_pages:
+            compress_page(page, data)
+    else:
+        count("pages_unchanged")
+        if gzip_pages and not os.path.exists(page + ".gz"):
+            compress_page(page, data)
+
+### Remove any .html files that are currently in the output directory and its subdirectories that were not created during this build.
+### This is to provide "overwrite" functionality.
+# With --atomic, these files are simply not carried over to the staging directory.
+def remove_old_pages():
+    for dirpath, dirnames, filenames in os.walk(output_dir):
+        for file in filenames:
+            path = os.path.join(dirpath, file)
+            if is_old_file(path):
+                submit_write(remove_file, path)
+    flush_writes()
+    # If any directory is empty after this "overwrite", remove the directory. Subdirectories are visited first, so that a directory that only contained empty directories is removed as well.
+    for dirpath, dirnames, filenames in os.walk(output_dir, topdown=False):
+        for dirname in dirnames:
+            path = os.path.join(dirpath, dirname)
+            if len(os.listdir(path)) == 0:
+                os.rmdir(path)
+                count("directories_deleted")
+
+def remove_file(path):
+    os.remove(path)
+    count("files_deleted")
+
+### Build the whole site: parse the source files, plan the pages, and write every page that changed to output_dir.
+# Returns the number of posts, the number of pages and the number of pages that were written.
+# previous_build holds the record of the last build (see find_dirty_pages). With -i it is loaded from the manifest for the first build. With --watch or rebuild() it is kept in memory between builds.
+# If neither is used, every page is written.
+# Templates that changed since they were last read are read again, along with formatting every post again.
+previous_build = None
+last_source_stats = None
+staging_dir = None
+def build(source_stats=None):
+    global post_objects, post_index, listings, main_pages, category_links, date_links, all_pages, permalink_pages, fragment_files, dirty_pages, staging_dir, previous_build, last_source_stats
+    build_start = phase_start = time.perf_counter()
+    pages_written = profile_counters.get("pages_written", 0)
+    if get_template_stats() != template_stats:
+        load_templates()
+        formatted_posts_cache.clear()
+        formatted_excerpts_cache.clear()
+    if source_stats is None:
+        source_stats = scan_source_files()
+        count("files_scanned", len(source_stats))
+        phase_start = record_phase("scan", phase_start)
+    last_source_stats = source_stats
+    post_objects = load_posts(source_stats)
+    phase_start = record_phase("parse", phase_start)
+    sort_posts(post_objects)
+    phase_start = record_phase("sort", phase_start)
+    number_posts(post_objects)
+    post_index = {obj.path: index for index, obj in enumerate(post_objects)}
+    listings, main_pages, category_links, date_links = plan_listings(post_objects)
+    all_pages = set(page for listing in listings for page in listing[0])
+    permalink_pages = set(output_dir + get_permalink(obj) for obj in post_objects) if permalinks else set()
+    fragment_files = set(get_fragment_path(page) for page in all_pages) if json_pages else set()
+    phase_start = record_phase("plan", phase_start)
+    find_assets()
+    find_image_sizes()
+    phase_start = record_phase("assets", phase_start)
+
+    if track_builds:
+        settings_signature = get_settings_signature()
+        if previous_build is None and incremental:
+            previous_build = load_manifest(settings_signature)
+        elif previous_build is not None and previous_build["settings"] != settings_signature:
+            previous_build = None
+        dirty_pages, current_build = find_dirty_pages(previous_build, settings_signature)
+    else:
+        dirty_pages = set(all_pages)
+    phase_start = record_phase("track", phase_start)
+
+    # With --profile-render, formatting posts and writing pages are profiled with cProfile.
+    if profile_render is not None:
+        render_profile = cProfile.Profile()
+        render_profile.enable()
+    if not low_memory:
+        format_dirty_posts()
+    phase_start = record_phase("format", phase_start)
+
+    ### Call write_pages to generate .html pages in output_dir for every post.
+    if atomic:
+        staging_dir = create_staging_dir()
+    start_compression()
+    start_writing()
+    url_hashes.clear()
+    link_lists.clear()
+    publish_assets()
+    write_link_includes()
+    for page_list, page_posts, page_dir, subdir, label in listings:
+        write_pages(page_list, page_posts, page_dir, subdir, label)
+    flush_writes()
+    finish_compression()
+    phase_start = record_phase("write", phase_start)
+    write_search_index()
+    flush_writes()
+    phase_start = record_phase("search", phase_start)
+    write_url_manifest()
+    phase_start = record_phase("urls", phase_start)
+    if profile_render is not None:
+        render_profile.disable()
+        render_profile.dump_stats(get_profile_path(profile_render))
+    if not atomic:
+        remove_old_pages()
+        stop_writing()
+        phase_start = record_phase("cleanup", phase_start)
+
+    ### Save the build manifest and the source index for the next incremental run.
+    # The manifest is written to a temporary file first, so that an interrupted run never leaves a half-written manifest behind.
+    if incremental:
+        save_source_index(source_stats)
+        with open(get_staged_path(manifest_path) + ".tmp", "w") as f:
+            json.dump(current_build, f)
+        os.replace(get_staged_path(manifest_path) + ".tmp", get_staged_path(manifest_path))
+        phase_start = record_phase("manifest", phase_start)
+
+    ### Finish an --atomic build: copy over every file of output_dir that was not generated during this build (except for old .html pages), then swap staging_dir with output_dir.
+    if atomic:
+        carry_over_files()
+        stop_writing()
+        swap_staging_dir()
+        phase_start = record_phase("swap", phase_start)
+
+    if track_builds:
+        previous_build = current_build
+    pages_written = profile_counters.get("pages_written", 0) - pages_written
+    if profile is not None:
+        save_profile_report(time.perf_counter() - build_start)
+    return {"posts": len(post_objects), "pages": len(all_pages), "pages_written": pages_written}
+
+def forget_previous_build():
+    global previous_build, last_source_stats, track_builds
+    previous_build = None
+    last_source_stats = None
+    track_builds = incremental or watch
+
+### Rebuild the site after the given files changed, without scanning the whole source directory. This is meant for long-running processes that import this script (see README.md).
+# Paths may point to source files that were changed, added or removed. Changed templates are picked up by build() in any case.
+# If a source file was added, the source directory is scanned again, so that posts keep the same order as in a full build.
+# From the first rebuild on, the record of every build is kept in memory, so that only pages that changed are written.
+def rebuild(changed_paths):
+    global track_builds
+    track_builds = True
+    if last_source_stats is None:
+        return build()
+    source_stats = dict(last_source_stats)
+    for path in changed_paths:
+        path = os.path.abspath(os.path.expanduser(path))
+        if not path.startswith(source_dir) or not is_source_file(os.path.basename(path)):
+            continue
+        if not os.path.isfile(path):
+            source_stats.pop(path, None)
+        elif path not in source_stats:
+            source_stats = None
+            break
+        else:
+            file_stat = os.stat(path)
+            source_stats[path] = (file_stat.st_mtime_ns, file_stat.st_size)
+    return build(source_stats)
+
+# With several config files, the name of the config file of the site is added to the path of every report (e.g. "report.blog1.json" for "report.json" and "blog1.ini").
+def get_profile_path(path):
+    if len(configs) == 1:
+        return path
+    stem, extension = os.path.splitext(path)
+    return stem + "." + os.path.splitext(os.path.basename(config))[0] + extension
+
+# Times are in seconds, memory and counters of bytes in bytes. The counters are reset after every report, so that in --watch mode every report covers one build.
+def save_profile_report(build_time):
+    report = dict()
+    report["build_time"] = build_time
+    report["phases"] = dict(profile_times)
+    report["counters"] = {counter: profile_counters.get(counter, 0) for counter in counter_names}
+    report["peak_memory"] = tracemalloc.get_traced_memory()[1]
+    report["jobs"] = jobs
+    with open(get_profile_path(profile), "w") as f:
+        json.dump(report, f, indent=2)
+    print("Profile report saved to " + get_profile_path(profile))
+    profile_times.clear()
+    profile_counters.clear()
+    tracemalloc.reset_peak()
+
+### Build several sites, one for every config file given with -c.
+# The sites are built one after another, so that templates and source files that sites have in common are only read once. With -j, the sites are spread across several processes instead, and every process builds its share of the sites one after another (with a single process each). Consecutive config files are built by the same process, so list sites that share templates next to each other.
+# An error in one site does not stop the others from being built. A summary of every site is printed at the end.
+def build_site(path):
+    print("Building site: " + path)
+    start = time.perf_counter()
+    try:
+        select_config(path)
+        result = build()
+    except SystemExit:
+        return {"config": path, "error": "see the messages above"}
+    except Exception as err:
+        traceback.print_exc()
+        return {"config": path, "error": repr(err)}
+    result["config"] = path
+    result["time"] = time.perf_counter() - start
+    return result
+
+def build_site_in_worker(path):
+    global jobs
+    jobs = 1
+    return build_site(path)
+
+def build_sites():
+    if jobs > 1 and len(configs) > 1:
+        processes = min(jobs, len(configs))
+        chunksize = -(-len(configs) // processes)
+        with multiprocessing.get_context("fork").Pool(processes) as pool:
+            results = pool.map(build_site_in_worker, configs, chunksize)
+    else:
+        results = [build_site(path) for path in configs]
+
+    print(f"\nBuilt {len(results)} sites:")
+    failed = False
+    for result in results:
+        if "error" in result:
+            failed = True
+            print(f"{result['config']}: FAILED ({result['error']})")
         else:
-            contents = contents.replace("(LABEL)", "All Posts")
+            print(f"{result['config']}: {result['posts']} posts, {result['pages']} pages ({result['pages_written']} written) in {result['time']:.2f} seconds")
+    if failed:
+        sys.exit(2)
+
+### Functions for --watch
+# The preview server serves output_dir over HTTP. Responses are never cached by the browser, so a reload always shows the latest build.
+# With --atomic, output_dir is looked up again for every request, so the server follows the swapped directory.
+# Without --fingerprint-assets, pages link to the style sheet and images where they are, outside of output_dir. A browser resolves such a link to a path below the root of the server, with the directories that it could not leave dropped (e.g. "../../doc/style.css" on "/dogs/index.html" becomes "/doc/style.css"). With -a, the link is the absolute path of the file.
+# If a requested file does not exist in output_dir, it is therefore looked up in every directory above output_dir, up to "/". Only the style sheet, the images of posts and files in output_dir are served this way (see preview_files).
+preview_files = set()
+
+class PreviewRequestHandler(http.server.SimpleHTTPRequestHandler):
+    def translate_path(self, path):
+        translated = super().translate_path(path)
+        if os.path.exists(translated):
+            return translated
+        relative = os.path.relpath(translated, self.directory)
+        directory = os.path.normpath(self.directory)
+        while True:
+            candidate = os.path.join(directory, relative)
+            if candidate in preview_files or (candidate.startswith(output_dir) and os.path.isfile(candidate)):
+                return candidate
+            if directory == os.path.dirname(directory):
+                return translated
+            directory = os.path.dirname(directory)
 
-        beginning_link = '<li><a href="' + main_pages[0] + '">All Posts</a></li>'
-        contents = contents.replace("(CATEGORY_LINKS)", format_links(category_links, beginning_link))
-        contents = contents.replace("(DATE_LINKS)", format_links(date_links, ""))
+    def end_headers(self):
+        self.send_header("Cache-Control", "no-store")
+        super().end_headers()
 
-        with open(page_list[page_number], "w") as f:
-            f.write(contents)
+    def log_message(self, format, *args):
+        pass
 
-final_process_pages(main_pages, "", "", category_links, date_links, main_pages, stylesheet)
-for category in category_pages:
-    final_process_pages(category_pages[category], category.replace(" ", "_"), category, category_links, date_links, main_pages, stylesheet)
-for date in date_pages:
-    final_process_pages(date_pages[date], date.replace(" ", "_"), date, category_links, date_links, main_pages, stylesheet)
+def start_preview_server():
+    handler = functools.partial(PreviewRequestHandler, directory=output_dir)
+    try:
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", port), handler)
+    except OSError as err:
+        print("Could not start the preview server on port " + str(port) + ": " + str(err.strerror) + ". Use --port=N to choose a different port.")
+        sys.exit(2)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# The set is replaced rather than changed, as the threads of the preview server read it at the same time.
+def update_preview_files():
+    global preview_files
+    preview_files = set([stylesheet] + [image for obj in post_objects for image in get_images(obj)])
+
+# Changes to the style sheet and to images are watched as well, since they are published with --fingerprint-assets and measured with --lazy-images.
+def get_watched_stats():
+    stats = get_template_stats()
+    for path in sorted(preview_files):
+        try:
+            stats.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            stats.append(None)
+    return stats
+
+# Source files, templates, the style sheet and images are polled for changes. Between builds the parsed posts, formatted posts and page signatures stay in memory, so a rebuild only parses, formats and writes what changed.
+# An error during a rebuild is printed, and the watch loop keeps running with the site of the last successful build. This includes errors that end a normal run with sys.exit (e.g. files that could not be written, see flush_writes), whose messages are printed before they exit.
+def watch_for_changes():
+    update_preview_files()
+    server = start_preview_server()
+    print("Serving " + output_dir + " on http://127.0.0.1:" + str(server.server_address[1]) + "/ Watching for changes. Press Ctrl+C to stop.")
+    source_stats = scan_source_files()
+    watched_stats = get_watched_stats()
+    try:
+        while True:
+            time.sleep(0.5)
+            try:
+                new_source_stats = scan_source_files()
+                new_watched_stats = get_watched_stats()
+                if new_source_stats == source_stats and new_watched_stats == watched_stats:
+                    continue
+                start_time = time.perf_counter()
+                # Only the scan that found the change counts for the report of the build, not every poll before it
+                count("files_scanned", len(new_source_stats))
+                source_stats = new_source_stats
+                watched_stats = new_watched_stats
+                build(source_stats)
+                # Images that were added to a post are watched from now on
+                update_preview_files()
+                watched_stats = get_watched_stats()
+                print(f"Rebuilt in {time.perf_counter() - start_time:.3f} seconds.")
+            except Exception:
+                traceback.print_exc()
+            except SystemExit:
+                print("The rebuild failed. Watching for changes.")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+# The build is only started when the script is run directly. When it is imported, call configure() and then build() or rebuild() (see README.md).
+if __name__ == "__main__":
+    configure(sys.argv[1:])
+    if len(configs) > 1:
+        build_sites()
+    else:
+        build()
+        if watch:
+            watch_for_changes()